@@ -4,14 +4,21 @@ description: This is a community provided integration for users to use as is and
 logoUrl: https://salespublic.s3.amazonaws.com/storage.png
 """
 
+import re
 import time
 import json
+import threading
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from lhub_integ.params import ConnectionParam, ActionParam, InputType, JinjaTemplatedStr, DataType, ValidationError
 from lhub_integ.common import input_helpers, file_manager_client, validations, verify_ssl
 from lhub_integ import action, connection_validator
-from azure.data.tables import TableServiceClient, TableClient
+from azure.data.tables import TableServiceClient, TableClient, TableTransactionError, UpdateMode
 from azure.core.credentials import AzureNamedKeyCredential
-from azure.core.exceptions import HttpResponseError, ResourceExistsError
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceExistsError
+from azure.core.pipeline.transport import RequestsTransport
 import datetime
 
 ACCOUNT_NAME = ConnectionParam("ACCOUNT_NAME",
@@ -20,6 +27,27 @@ ACCOUNT_NAME = ConnectionParam("ACCOUNT_NAME",
 ACCESS_KEY = ConnectionParam("ACCESS_KEY",
                              description="This is the access key",
                              input_type=InputType.PASSWORD)
+POOL_SIZE = ActionParam("POOL_SIZE", description="Number of keep-alive connections kept open to the table service", optional=True,
+                        input_type=InputType.TEXT, data_type=DataType.INT, default="10", action=["list_table","create_table","insert_entity","query_entities","list_entities","delete_entity","bulk_insert_entities"])
+RETRY_TOTAL = ActionParam("RETRY_TOTAL", description="Number of times a failed request is retried", optional=True,
+                          input_type=InputType.TEXT, data_type=DataType.INT, default="3", action=["list_table","create_table","insert_entity","query_entities","list_entities","delete_entity","bulk_insert_entities"])
+RETRY_BACKOFF = ActionParam("RETRY_BACKOFF", description="Backoff factor in seconds between retries, the wait doubles after every retry", optional=True,
+                            input_type=InputType.TEXT, data_type=DataType.NUMBER, default="0.8", action=["list_table","create_table","insert_entity","query_entities","list_entities","delete_entity","bulk_insert_entities"])
+BULK_MODE = ActionParam("BULK_MODE", description="insert fails on entities that already exist, upsert_merge updates their given properties and upsert_replace replaces them", optional=True,
+                        input_type=InputType.SELECT, options=["insert", "upsert_merge", "upsert_replace"], default="insert", action="bulk_insert_entities")
+BULK_WORKERS = ActionParam("BULK_WORKERS", description="Number of transactions sent at the same time, keep it within POOL_SIZE", optional=True,
+                           input_type=InputType.TEXT, data_type=DataType.INT, default="8", action="bulk_insert_entities")
+
+base_path = "/opt/files/shared/integrationsFiles/"
+# operations allowed in one entity group transaction, and the payload size kept under its 4 MiB limit
+TRANSACTION_SIZE = 100
+TRANSACTION_MAX_BYTES = 3 * 1024 * 1024
+
+# service clients by account and client settings, and table clients by service client and table, created on first use
+# and kept for the life of the process so that their connections are reused
+service_clients = {}
+table_clients = {}
+clients_lock = threading.Lock()
 
 
 @action(name="List Tables")
@@ -29,14 +57,10 @@ def list_table():
     :return: a list of table_names
     """
     table_listing = []
-    credential = AzureNamedKeyCredential(ACCOUNT_NAME.read(), ACCESS_KEY.read())
-    with TableServiceClient(endpoint="https://" + ACCOUNT_NAME.read() + ".table.core.windows.net",
-                            credential=credential) as table_service:
-        list_tables = table_service.list_tables()
-        for table in list_tables:
-            table_listing.append({"table_name": table.name})
-        return table_listing
-    return None
+    list_tables = service_client().list_tables()
+    for table in list_tables:
+        table_listing.append({"table_name": table.name})
+    return table_listing
 
 @action(name="Create Table")
 def create_table(table_name):
@@ -45,10 +69,7 @@ def create_table(table_name):
     :param table_name: the name of the table, if not defined by previous nodes, you can ="table_name". Table name has to be in a format supported by Azure.
     :return:
     """
-    credential = AzureNamedKeyCredential(ACCOUNT_NAME.read(), ACCESS_KEY.read())
-    with TableServiceClient(endpoint="https://" + ACCOUNT_NAME.read() + ".table.core.windows.net",
-                            credential=credential) as table_service:
-        table_client = table_service.create_table_if_not_exists(table_name=table_name)
+    service_client().create_table_if_not_exists(table_name=table_name)
     return {"message":"created"}
 
 # todo: Will implement the delete table action later
@@ -62,19 +83,16 @@ def insert_entity(table_name, entity):
     :return:
     """
     entity = json.loads(entity)
-    credential = AzureNamedKeyCredential(ACCOUNT_NAME.read(), ACCESS_KEY.read())
-    with TableServiceClient(endpoint="https://" + ACCOUNT_NAME.read() + ".table.core.windows.net",
-                            credential=credential) as table_service:
-        table_client = table_service.get_table_client(table_name=table_name)
-        try:
-            resp = table_client.create_entity(entity=entity)
-            print(resp)
-            return {"message":"inserted"}
-        except ResourceExistsError:
-            print("Entity already exists")
-            return {"message":"failed"}
-        except HttpResponseError as e:
-            return {"message":e.message, "status":e.status_code, "reason":e.reason}
+    table_client = get_table_client(table_name)
+    try:
+        resp = table_client.create_entity(entity=entity)
+        print(resp)
+        return {"message":"inserted"}
+    except ResourceExistsError:
+        print("Entity already exists")
+        return {"message":"failed"}
+    except HttpResponseError as e:
+        return {"message":e.message, "status":e.status_code, "reason":e.reason}
             
 @action(name="Query Entities")
 def query_entities(table_name, filters):
@@ -86,19 +104,16 @@ def query_entities(table_name, filters):
     :return:
     """
     returnVal = []
-    credential = AzureNamedKeyCredential(ACCOUNT_NAME.read(), ACCESS_KEY.read())
-    with TableServiceClient(endpoint="https://" + ACCOUNT_NAME.read() + ".table.core.windows.net",
-                            credential=credential) as table_service:
-        table_client = table_service.get_table_client(table_name=table_name)
-        try:
-            resp = table_client.query_entities(query_filter=filters)
-            for entity_chosen in resp:
-                returnVal.append(json.dumps(entity_chosen))
-            if returnVal :
-                return returnVal
-            return {"message":"zero match"}
-        except Exception as e:
-            return {"message":str(e)} 
+    table_client = get_table_client(table_name)
+    try:
+        resp = table_client.query_entities(query_filter=filters)
+        for entity_chosen in resp:
+            returnVal.append(json.dumps(entity_chosen))
+        if returnVal :
+            return returnVal
+        return {"message":"zero match"}
+    except Exception as e:
+        return {"message":str(e)} 
             
 @action(name="List Entities")
 def list_entities(table_name):
@@ -108,17 +123,14 @@ def list_entities(table_name):
     :return:
     """
     returnVal=[]
-    credential = AzureNamedKeyCredential(ACCOUNT_NAME.read(), ACCESS_KEY.read())
-    with TableServiceClient(endpoint="https://" + ACCOUNT_NAME.read() + ".table.core.windows.net",
-                            credential=credential) as table_service:
-        table_client = table_service.get_table_client(table_name=table_name)
-        try:
-            resp = table_client.list_entities()
-            for entity_chosen in resp:
-                returnVal.append(json.dumps(entity_chosen))
-            return returnVal
-        except Exception as e:
-            return {"message":str(e)}    
+    table_client = get_table_client(table_name)
+    try:
+        resp = table_client.list_entities()
+        for entity_chosen in resp:
+            returnVal.append(json.dumps(entity_chosen))
+        return returnVal
+    except Exception as e:
+        return {"message":str(e)}    
             
 @action(name="Delete Entity")
 def delete_entity(table_name, PartitionKey, RowKey):
@@ -130,12 +142,135 @@ def delete_entity(table_name, PartitionKey, RowKey):
     :return:
     """
     returnVal=[]
-    credential = AzureNamedKeyCredential(ACCOUNT_NAME.read(), ACCESS_KEY.read())
-    with TableServiceClient(endpoint="https://" + ACCOUNT_NAME.read() + ".table.core.windows.net",
-                            credential=credential) as table_service:
-        table_client = table_service.get_table_client(table_name=table_name)
+    table_client = get_table_client(table_name)
+    try:
+        resp = table_client.delete_entity(partition_key=PartitionKey, row_key=RowKey)
+        return {"message":"deleted"}
+    except Exception as e:
+        return {"message":str(e)}                
+
+
+@action(name="Bulk Insert Entities")
+def bulk_insert_entities(table_name, entities):
+    """
+    Insert or upsert many rows of data, grouped by PartitionKey into transactions of up to 100 entities that are sent concurrently
+    :param table_name: the name of the table, if not defined by previous nodes, you can ="table_name". Table name has to be in a format supported by Azure.
+    :param entities: a json array of data entities, or the file ID of a file holding a json array or one entity per line. Every entity must include PartitionKey and RowKey
+    :return: the number of entities written and the ones that failed with their error
+    """
+    try:
+        entities = read_entities(entities)
+    except (ValueError, OSError) as e:
+        return {"message":"entities could not be read: " + str(e)}
+    failures = []
+    partitions = OrderedDict()
+    for index, entity in enumerate(entities):
+        if not isinstance(entity, dict) or "PartitionKey" not in entity or "RowKey" not in entity:
+            failures.append(entity_failure(index, entity, "PartitionKey and RowKey are required"))
+            continue
+        partitions.setdefault(entity["PartitionKey"], []).append((index, entity))
+    operation = {"insert": ("create", {}), "upsert_merge": ("upsert", {"mode": UpdateMode.MERGE}),
+                 "upsert_replace": ("upsert", {"mode": UpdateMode.REPLACE})}[BULK_MODE.read()]
+    table_client = get_table_client(table_name)
+    chunks = [chunk for partition in partitions.values() for chunk in transaction_chunks(partition)]
+    with ThreadPoolExecutor(max_workers=max(1, BULK_WORKERS.read())) as executor:
+        for chunk_failures in executor.map(lambda chunk: submit_chunk(table_client, operation, chunk), chunks):
+            failures.extend(chunk_failures)
+    failures.sort(key=lambda failure: failure["index"])
+    return {"message":"completed", "entities":len(entities), "written":len(entities) - len(failures),
+            "transactions":len(chunks), "failed":len(failures), "failures":failures}
+
+
+def read_entities(entities):
+    """
+    Accept a JSON array of entities, or a file ID of a file holding either a JSON array or one JSON entity per line.
+    """
+    try:
+        values = json.loads(entities)
+        if isinstance(values, list):
+            return values
+    except ValueError:
+        pass
+    with open(base_path + entities, "r") as entities_file:
+        content = entities_file.read()
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def transaction_chunks(partition):
+    """
+    Split the (index, entity) pairs of one partition into transactions within TRANSACTION_SIZE and TRANSACTION_MAX_BYTES.
+    """
+    chunk = []
+    size = 0
+    for index, entity in partition:
+        entity_size = len(json.dumps(entity, default=str))
+        if chunk and (len(chunk) == TRANSACTION_SIZE or size + entity_size > TRANSACTION_MAX_BYTES):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((index, entity))
+        size = size + entity_size
+    if chunk:
+        yield chunk
+
+
+def submit_chunk(table_client, operation, chunk):
+    """
+    Submit the chunk as one transaction. A transaction fails as a whole, so when the error names the entity it failed on
+    that entity is set aside and the rest is submitted again. Errors of the whole transaction, such as throttling or a lost
+    connection, fail every entity of the chunk once.
+    :return: the failed entities with their error
+    """
+    failures = []
+    while chunk:
         try:
-            resp = table_client.delete_entity(partition_key=PartitionKey, row_key=RowKey)
-            return {"message":"deleted"}
-        except Exception as e:
-            return {"message":str(e)}                
+            table_client.submit_transaction([(operation[0], entity, operation[1]) for index, entity in chunk])
+            return failures
+        except TableTransactionError as e:
+            # the service prefixes the message with the index of the failed operation, "3:The specified entity already exists"
+            failed = re.match(r'\s*(\d+):', e.message or "")
+            if failed is None or int(failed.group(1)) >= len(chunk):
+                return failures + [entity_failure(index, entity, e.message) for index, entity in chunk]
+            index, entity = chunk.pop(int(failed.group(1)))
+            failures.append(entity_failure(index, entity, e.message))
+        except AzureError as e:
+            return failures + [entity_failure(index, entity, e.message) for index, entity in chunk]
+    return failures
+
+
+def entity_failure(index, entity, error):
+    if not isinstance(entity, dict):
+        entity = {}
+    return {"index":index, "PartitionKey":entity.get("PartitionKey"), "RowKey":entity.get("RowKey"), "error":error}
+
+
+def service_client():
+    """
+    The service client of the account, shared by every action of this process. Its requests session keeps up to
+    POOL_SIZE connections alive, and failed requests are retried RETRY_TOTAL times with exponential backoff.
+    """
+    key = (ACCOUNT_NAME.read(), ACCESS_KEY.read(), POOL_SIZE.read(), RETRY_TOTAL.read(), RETRY_BACKOFF.read())
+    with clients_lock:
+        if key not in service_clients:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=key[2], pool_maxsize=key[2])
+            session.mount("https://", adapter)
+            service_clients[key] = TableServiceClient(endpoint="https://" + key[0] + ".table.core.windows.net",
+                                                      credential=AzureNamedKeyCredential(key[0], key[1]),
+                                                      transport=RequestsTransport(session=session, session_owner=False),
+                                                      retry_total=key[3], retry_backoff_factor=key[4])
+        return service_clients[key]
+
+
+def get_table_client(table_name):
+    """
+    The client of the table, it sends its requests through the connections of the service client.
+    """
+    table_service = service_client()
+    with clients_lock:
+        key = (id(table_service), table_name)
+        if key not in table_clients:
+            table_clients[key] = table_service.get_table_client(table_name=table_name)
+        return table_clients[key]
@@ -3,15 +3,98 @@ name: ScreenShots
 description: This Integration uses Selenium Webdriver to take screenshots. This is a custom integration provided 'as is' with open source and no warranty.
 logoUrl: https://s3.amazonaws.com/lhub-public/integrations/default-integration-logo.svg
 """
-from lhub_integ.params import ConnectionParam, ActionParam
+from lhub_integ.params import ConnectionParam, ActionParam, InputType, DataType
 from lhub_integ import action
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.common.exceptions import TimeoutException
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
 import os
 import uuid
-import tempfile
 import sys
-import distutils.spawn
+import json
+import time
+import base64
+import hashlib
+import atexit
+import shutil
+import threading
+import functools
+import contextlib
+
+# browser viewport, part of the screenshot cache key
+WINDOW_SIZE = "1920,1080"
+# file extension of every capture format
+IMAGE_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+# viewport profiles that can be named in VIEWPORTS
+VIEWPORT_PRESETS = {
+    "desktop": {"width": 1920, "height": 1080, "device_scale_factor": 1, "mobile": False},
+    "laptop": {"width": 1366, "height": 768, "device_scale_factor": 1, "mobile": False},
+    "tablet": {"width": 768, "height": 1024, "device_scale_factor": 2, "mobile": True},
+    "mobile": {"width": 390, "height": 844, "device_scale_factor": 3, "mobile": True},
+}
+# page load timeout chromedriver applies when none is set
+DEFAULT_PAGE_LOAD_TIMEOUT = 300
+# URL patterns blocked for every resource type of the fast render mode, CDP can only block by URL
+RESOURCE_TYPE_PATTERNS = {
+    "Image": ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico"],
+    "Media": ["*.mp4", "*.webm", "*.ogg", "*.ogv", "*.mp3", "*.wav", "*.m3u8", "*.ts"],
+    "Font": ["*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot"],
+    "Stylesheet": ["*.css"],
+    "Script": ["*.js"],
+}
+# number of idle browsers kept warm in this process
+POOL_SIZE = 2
+# seconds an idle browser is kept before it is shut down
+DRIVER_IDLE_TIMEOUT = 300
+# number of screenshots a browser takes before it is replaced by a fresh one
+DRIVER_MAX_USES = 50
+
+download_directory = "/opt/files/shared/integrationsFiles"
+# cached screenshots, File IDs handed out are links to them in download_directory
+SCREENSHOT_CACHE_DIR = os.path.join(download_directory, ".screenshot_cache")
+
+BATCH_SESSIONS = ActionParam("BATCH_SESSIONS", description="Number of browsers capturing the URLs at the same time", optional=True,
+                             input_type=InputType.TEXT, data_type=DataType.INT, default="4", action="screenshot_url_batch")
+URL_DEADLINE = ActionParam("URL_DEADLINE", description="Seconds a URL may take to load, what has rendered by then is captured. It replaces RENDER_DEADLINE for the batch", optional=True,
+                           input_type=InputType.TEXT, data_type=DataType.INT, default="30", action="screenshot_url_batch")
+SCREENSHOT_CACHE_TTL = ActionParam("SCREENSHOT_CACHE_TTL", description="Seconds a screenshot of the same URL or HTML content is reused instead of rendering again, 0 disables the cache", optional=True,
+                                   input_type=InputType.TEXT, data_type=DataType.INT, default="3600",
+                                   action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+SCREENSHOT_CACHE_MAX_MB = ActionParam("SCREENSHOT_CACHE_MAX_MB", description="Disk space of cached screenshots, the least recently taken ones are removed past it", optional=True,
+                                      input_type=InputType.TEXT, data_type=DataType.INT, default="1024",
+                                      action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+IMAGE_FORMAT = ActionParam("IMAGE_FORMAT", description="Image format of the screenshot, jpeg and webp are much smaller than png", optional=True,
+                           input_type=InputType.SELECT, default="png", options=["png", "jpeg", "webp"], action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+IMAGE_QUALITY = ActionParam("IMAGE_QUALITY", description="Compression quality from 0 to 100 for jpeg and webp", optional=True,
+                            input_type=InputType.TEXT, data_type=DataType.INT, default="80", action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+FULL_PAGE = ActionParam("FULL_PAGE", description="Capture the whole page instead of the viewport", data_type=DataType.BOOL, optional=True,
+                        input_type=InputType.SELECT, default="False", options=["True", "False"], action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+CLIP = ActionParam("CLIP", description="Only capture this region of the page, as x,y,width,height in CSS pixels, eg, 0,0,800,600", optional=True,
+                   input_type=InputType.TEXT, default=None, action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+RENDER_MODE = ActionParam("RENDER_MODE", description="normal waits for the page to fully load. fast stops waiting early, blocks the resources below and captures what has rendered by the deadline", optional=True,
+                          input_type=InputType.SELECT, default="normal", options=["normal", "fast"], action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+LOAD_STRATEGY = ActionParam("LOAD_STRATEGY", description="Page load strategy of the fast mode, eager returns once the DOM is ready and none returns right away", optional=True,
+                            input_type=InputType.SELECT, default="eager", options=["eager", "none"], action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+BLOCK_RESOURCE_TYPES = ActionParam("BLOCK_RESOURCE_TYPES", description="Comma separated resource types not loaded in fast mode: Image, Media, Font, Stylesheet, Script", optional=True,
+                                   input_type=InputType.TEXT, default="Media,Font", action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+BLOCK_URL_PATTERNS = ActionParam("BLOCK_URL_PATTERNS", description="Comma separated URL patterns with * wildcards not loaded in fast mode", optional=True,
+                                 input_type=InputType.TEXT, default="*google-analytics.com*,*googletagmanager.com*,*doubleclick.net*,*facebook.net*,*hotjar.com*", action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+RENDER_DEADLINE = ActionParam("RENDER_DEADLINE", description="Seconds the fast mode waits for the page before capturing", optional=True,
+                              input_type=InputType.TEXT, data_type=DataType.INT, default="10", action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+NETWORK_IDLE_MS = ActionParam("NETWORK_IDLE_MS", description="The fast mode considers the page rendered once no resource has finished loading for this many milliseconds", optional=True,
+                              input_type=InputType.TEXT, data_type=DataType.INT, default="500", action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+VIEWPORTS = ActionParam("VIEWPORTS", description="Capture the page once per viewport after a single load. Either comma separated names among desktop, laptop, tablet and mobile, or a JSON list such as [{\"name\": \"phone\", \"width\": 390, \"height\": 844, \"device_scale_factor\": 3, \"mobile\": true}]",
+                         optional=True, input_type=InputType.TEXT, default=None, action=["screenshot_file","screenshot_html_field","screenshot_url","screenshot_url_batch"])
+
+# idle browsers by page load strategy, each one is {"driver": ..., "strategy": ..., "uses": ..., "last_used": ...}
+driver_pools = {}
+driver_pool_lock = threading.Lock()
+pool_warmers = {}
+# idle browsers the running batches keep in the pool, one per batch session
+pool_reserved = {"browsers": 0}
 
 @action ("Screenshot File")
 def screenshot_file(html_file_id):
@@ -22,20 +105,20 @@ def screenshot_file(html_file_id):
     :return:
     """
     
-    download_directory = "/opt/files/shared/integrationsFiles"
-    file_id = str(uuid.uuid4())+".png"
-    
+    try:
+        options = capture_options()
+    except ValueError as e:
+        return {"has_error": "true", "error_msg": str(e)}
     html_file_location = os.path.join(download_directory, html_file_id)
-    screenshot_target = os.path.join(download_directory, file_id)
+    with open(html_file_location, "rb") as html_file:
+        keys = cache_keys("html", html_file.read(), options)
     
-    driver = make_driver()
-    enable_download_in_headless_chrome(driver, download_directory)
-    _ = get_screenshot_for_html_file(driver, html_file_location, screenshot_target)
-    driver.quit()
+    def capture(screenshot_targets):
+        with pooled_driver(options["load_strategy"]) as driver:
+            return get_screenshot_for_html_file(driver, html_file_location, screenshot_targets, options)
+    file_ids, timing = cached_screenshot(keys, capture, options)
     
-    return {
-        "lhub_file_id": file_id,
-    }
+    return screenshot_result(file_ids, timing, options)
 
 @action ("Screenshot HTML data column")
 def screenshot_html_field(html_column):
@@ -46,25 +129,17 @@ def screenshot_html_field(html_column):
     :return:
     """
     
-    download_directory = "/opt/files/shared/integrationsFiles"
-    file_id = str(uuid.uuid4())+".png"
-    
-    tmp_directory = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
-    os.mkdir(tmp_directory)
-    
-    html_file_location = os.path.join(tmp_directory, "tmp.html")
-    with open(html_file_location, "w") as output_file:
-      print(html_column, file=output_file)
-    screenshot_target = os.path.join(download_directory, file_id)
+    try:
+        options = capture_options()
+    except ValueError as e:
+        return {"has_error": "true", "error_msg": str(e)}
     
-    driver = make_driver()
-    enable_download_in_headless_chrome(driver, download_directory)
-    _ = get_screenshot_for_html_file(driver, html_file_location, screenshot_target)
-    driver.quit()
+    def capture(screenshot_targets):
+        with pooled_driver(options["load_strategy"]) as driver:
+            return get_screenshot_for_html(driver, html_column, screenshot_targets, options)
+    file_ids, timing = cached_screenshot(cache_keys("html", html_column.encode("utf-8"), options), capture, options)
     
-    return {
-        "lhub_file_id": file_id,
-    }
+    return screenshot_result(file_ids, timing, options)
     
 
 @action ("Screenshot URL")
@@ -76,22 +151,395 @@ def screenshot_url(url):
     :return:
     """
     
-    download_directory = "/opt/files/shared/integrationsFiles"
-    file_id = str(uuid.uuid4())+".png"
+    try:
+        options = capture_options()
+    except ValueError as e:
+        return {"has_error": "true", "error_msg": str(e)}
     
-    screenshot_target = os.path.join(download_directory, file_id)
-    
-    driver = make_driver()
-    enable_download_in_headless_chrome(driver, download_directory)
-    _ = get_screenshot_for_url(driver, url, screenshot_target)
-    driver.quit()
+    file_ids, timing = capture_url(url, options)
     
+    return screenshot_result(file_ids, timing, options)
+
+@action ("Screenshot URL Batch")
+def screenshot_url_batch(urls):
+    """
+    Capture many URLs at the same time with a bounded number of browsers. A slow site only holds up its own browser until its deadline.
+    :param urls: JSON array of URLs, or the File ID of a file with one URL per line
+    :label urls: URLs
+    :return: the File ID or the error of every URL
+    """
+    urls = read_urls(urls)
+    try:
+        options = capture_options()
+    except ValueError as e:
+        return {"has_error": "true", "error_msg": str(e)}
+    options["deadline"] = URL_DEADLINE.read()
+    sessions = max(1, BATCH_SESSIONS.read())
+    with pool_reservation(sessions), ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [(url, executor.submit(capture_url, url, options)) for url in urls]
+    results = {}
+    for url, future in futures:
+        try:
+            file_ids, timing = future.result()
+            results[url] = screenshot_result(file_ids, timing, options)
+            results[url]["timed_out"] = timing["timed_out"]
+        except Exception as e:
+            results[url] = {"has_error": "true", "error_msg": str(e)}
     return {
-        "lhub_file_id": file_id,
+        "results": results,
     }
+
+def read_urls(urls):
+    try:
+        values = json.loads(urls)
+        if isinstance(values, list):
+            return list(dict.fromkeys(values))
+    except ValueError:
+        pass
+    with open(os.path.join(download_directory, urls), "r") as url_file:
+        return list(dict.fromkeys(line.strip() for line in url_file if line.strip()))
+
+def capture_url(url, options):
+    def capture(screenshot_targets):
+        with pooled_driver(options["load_strategy"]) as driver:
+            return get_screenshot_for_url(driver, url, screenshot_targets, options)
+    return cached_screenshot(cache_keys("url", normalize_url(url).encode("utf-8"), options), capture, options)
+
+def screenshot_result(file_ids, timing, options):
+    result = {"lhub_file_id": file_ids[0], "timing": timing}
+    if options["viewports"]:
+        result["viewports"] = {viewport["name"]: file_id for viewport, file_id in zip(options["viewports"], file_ids)}
+    return result
+
+def normalize_url(url):
+    """
+    Lower case the scheme and host, drop the default port and the fragment, so equivalent URLs share a cache entry.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+def capture_options():
+    options = {"format": IMAGE_FORMAT.read(), "quality": IMAGE_QUALITY.read(), "full_page": FULL_PAGE.read(), "clip": read_clip(CLIP.read() or ""),
+               "render_mode": RENDER_MODE.read(), "load_strategy": "normal", "blocked_urls": [], "deadline": None, "idle_ms": 0,
+               "viewports": read_viewports(VIEWPORTS.read() or "")}
+    if options["render_mode"] == "fast":
+        options["load_strategy"] = LOAD_STRATEGY.read()
+        options["blocked_urls"] = blocked_urls(BLOCK_RESOURCE_TYPES.read() or "", BLOCK_URL_PATTERNS.read() or "")
+        options["deadline"] = RENDER_DEADLINE.read()
+        options["idle_ms"] = NETWORK_IDLE_MS.read()
+    return options
+
+def read_viewports(viewports):
+    """
+    Turn preset names or a JSON list of profiles into a list of complete viewport profiles.
+    :raise ValueError: when a name is not a preset or a profile has no valid width and height
+    """
+    if not viewports.strip():
+        return []
+    presets = ", ".join(VIEWPORT_PRESETS)
+    if viewports.strip().startswith("["):
+        try:
+            profiles = json.loads(viewports)
+        except ValueError as e:
+            raise ValueError("VIEWPORTS is not a valid JSON list: {}".format(e))
+    else:
+        profiles = []
+        for name in viewports.split(","):
+            name = name.strip()
+            if not name:
+                continue
+            if name not in VIEWPORT_PRESETS:
+                raise ValueError("Unknown viewport preset {!r}, the presets are {}".format(name, presets))
+            profiles.append(dict(VIEWPORT_PRESETS[name], name=name))
+    for index, profile in enumerate(profiles):
+        if not isinstance(profile, dict) or not all(
+                isinstance(profile.get(size), int) and not isinstance(profile.get(size), bool) and profile.get(size) > 0
+                for size in ("width", "height")):
+            raise ValueError("Viewport {} needs a positive integer width and height, or use one of the presets {}".format(index + 1, presets))
+        profile.setdefault("name", "viewport{}".format(index + 1))
+        profile.setdefault("device_scale_factor", 1)
+        profile.setdefault("mobile", False)
+    return profiles
+
+def read_clip(clip):
+    """
+    Turn x,y,width,height into a list of four numbers, or an empty list when no region is given.
+    :raise ValueError: when it is not four numbers with a positive width and height
+    """
+    if not clip.strip():
+        return []
+    try:
+        region = [float(value) for value in clip.split(",")]
+    except ValueError:
+        region = []
+    if len(region) != 4 or region[2] <= 0 or region[3] <= 0:
+        raise ValueError("CLIP must be x,y,width,height in CSS pixels with a positive width and height, eg, 0,0,800,600, not {!r}".format(clip))
+    return region
+
+def blocked_urls(resource_types, url_patterns):
+    urls = []
+    for resource_type in resource_types.split(","):
+        for pattern in RESOURCE_TYPE_PATTERNS.get(resource_type.strip().capitalize(), []):
+            # also block the same URL with a query string
+            urls.extend([pattern, pattern + "?*"])
+    urls.extend(pattern.strip() for pattern in url_patterns.split(",") if pattern.strip())
+    return urls
+
+def cache_keys(kind, content, options):
+    """
+    One cache key per viewport of the options, or a single one for the default viewport.
+    """
+    keys = []
+    for viewport in options["viewports"] or [None]:
+        digest = hashlib.sha256()
+        for part in (kind.encode("utf-8"), WINDOW_SIZE.encode("utf-8"), json.dumps(options, sort_keys=True).encode("utf-8"),
+                     json.dumps(viewport, sort_keys=True).encode("utf-8"), content):
+            digest.update(part)
+            digest.update(b"\0")
+        keys.append(digest.hexdigest())
+    return keys
+
+def cached_screenshot(keys, capture, options):
+    """
+    Return new File IDs holding the screenshots taken with the same keys within the TTL, otherwise call capture(targets) to take
+    them all from a single page load. capture returns the load timing of its screenshots, timed out ones are not cached.
+    The cache entries themselves are never handed out, so evicting or replacing them leaves the files of earlier calls as they are.
+    :return: (File IDs, load timing)
+    """
+    ttl = SCREENSHOT_CACHE_TTL.read()
+    extension = IMAGE_EXTENSIONS[options["format"]]
+    new_file_ids = [str(uuid.uuid4())+extension for _ in keys]
+    new_targets = [os.path.join(download_directory, file_id) for file_id in new_file_ids]
+    if ttl <= 0:
+        return new_file_ids, capture(new_targets)
+    os.makedirs(SCREENSHOT_CACHE_DIR, exist_ok=True)
+    cache_paths = [os.path.join(SCREENSHOT_CACHE_DIR, key + extension) for key in keys]
+    try:
+        if all(time.time() - os.path.getmtime(cache_path) <= ttl for cache_path in cache_paths):
+            for cache_path, new_target in zip(cache_paths, new_targets):
+                link_file(cache_path, new_target)
+            return new_file_ids, {"cached": "true", "timed_out": "false"}
+    except OSError:
+        # expired, or evicted while it was being linked
+        for new_target in new_targets:
+            with contextlib.suppress(OSError):
+                os.remove(new_target)
+    timing = capture(new_targets)
+    if timing["timed_out"] == "true":
+        return new_file_ids, timing
+    for new_target, cache_path in zip(new_targets, cache_paths):
+        temp_path = cache_path + "." + str(uuid.uuid4())
+        link_file(new_target, temp_path)
+        os.replace(temp_path, cache_path)
+    evict_screenshot_cache(ttl, SCREENSHOT_CACHE_MAX_MB.read() * 1024 * 1024)
+    return new_file_ids, timing
+
+def link_file(source, target):
+    # a hard link costs no disk space, a copy is made where the file system has none
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def evict_screenshot_cache(ttl, max_bytes):
+    """
+    Remove the expired cached screenshots, then the oldest ones until the cache fits in max_bytes.
+    """
+    now = time.time()
+    entries = []
+    with os.scandir(SCREENSHOT_CACHE_DIR) as listing:
+        for entry in listing:
+            if os.path.splitext(entry.name)[1] in IMAGE_EXTENSIONS.values():
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if now - mtime <= ttl and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total = total - size
     
-def make_driver():
-    chromedriver = distutils.spawn.find_executable("chromedriver")
+@contextlib.contextmanager
+def pooled_driver(strategy="normal"):
+    """
+    Borrow a warm browser with this page load strategy from the pool and give it back with a clean state once the screenshot is taken.
+    """
+    entry = borrow_driver(strategy)
+    try:
+        yield entry["driver"]
+    finally:
+        return_driver(entry)
+
+def borrow_driver(strategy):
+    start_pool_warmer(strategy)
+    while True:
+        with driver_pool_lock:
+            driver_pool = driver_pools.setdefault(strategy, [])
+            entry = driver_pool.pop() if driver_pool else None
+        if entry is None:
+            return new_pool_entry(strategy)
+        if time.time() - entry["last_used"] <= DRIVER_IDLE_TIMEOUT and driver_alive(entry["driver"]):
+            return entry
+        # idle for too long or crashed, replace it
+        quit_driver(entry["driver"])
+
+def return_driver(entry):
+    entry["uses"] = entry["uses"] + 1
+    entry["last_used"] = time.time()
+    if entry["uses"] >= DRIVER_MAX_USES or not reset_driver(entry["driver"]):
+        quit_driver(entry["driver"])
+        return
+    expired = []
+    with driver_pool_lock:
+        driver_pool = driver_pools.setdefault(entry["strategy"], [])
+        for idle in list(driver_pool):
+            if entry["last_used"] - idle["last_used"] > DRIVER_IDLE_TIMEOUT:
+                driver_pool.remove(idle)
+                expired.append(idle)
+        if len(driver_pool) < pool_capacity():
+            driver_pool.append(entry)
+            entry = None
+    for idle in expired:
+        quit_driver(idle["driver"])
+    if entry:
+        quit_driver(entry["driver"])
+
+def pool_capacity():
+    # called with driver_pool_lock held
+    return max(POOL_SIZE, pool_reserved["browsers"])
+
+@contextlib.contextmanager
+def pool_reservation(sessions):
+    """
+    Keep up to sessions idle browsers per strategy while a batch runs, so a session giving its browser back while
+    the pool is full does not quit it only for the next URL to launch a new one. The extra browsers are shut down after.
+    """
+    with driver_pool_lock:
+        pool_reserved["browsers"] = pool_reserved["browsers"] + sessions
+    try:
+        yield
+    finally:
+        extra = []
+        with driver_pool_lock:
+            pool_reserved["browsers"] = pool_reserved["browsers"] - sessions
+            for driver_pool in driver_pools.values():
+                while len(driver_pool) > pool_capacity():
+                    # the oldest idle browsers are at the front
+                    extra.append(driver_pool.pop(0))
+        for entry in extra:
+            quit_driver(entry["driver"])
+
+def new_pool_entry(strategy):
+    driver = make_driver(strategy)
+    enable_download_in_headless_chrome(driver, download_directory)
+    # reset_driver finds the origins to clear in the resource timings, which only keep 250 entries by default
+    driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": "performance.setResourceTimingBufferSize(100000);"})
+    return {"driver": driver, "strategy": strategy, "uses": 0, "last_used": time.time()}
+
+def start_pool_warmer(strategy):
+    """
+    Launch the rest of the pool in the background the first time a browser with this strategy is needed.
+    """
+    with driver_pool_lock:
+        if strategy in pool_warmers:
+            return
+        pool_warmer = threading.Thread(target=warm_pool, args=(strategy,), daemon=True)
+        pool_warmers[strategy] = pool_warmer
+    pool_warmer.start()
+
+def warm_pool(strategy):
+    for _ in range(POOL_SIZE - 1):
+        try:
+            entry = new_pool_entry(strategy)
+        except Exception:
+            return
+        with driver_pool_lock:
+            driver_pool = driver_pools.setdefault(strategy, [])
+            if len(driver_pool) < POOL_SIZE:
+                driver_pool.append(entry)
+                entry = None
+        if entry:
+            quit_driver(entry["driver"])
+
+@atexit.register
+def shutdown_pool():
+    for pool_warmer in list(pool_warmers.values()):
+        pool_warmer.join()
+    with driver_pool_lock:
+        idle = [entry for driver_pool in driver_pools.values() for entry in driver_pool]
+        driver_pools.clear()
+    for entry in idle:
+        quit_driver(entry["driver"])
+
+def driver_alive(driver):
+    try:
+        driver.execute_script("return 1")
+        return True
+    except Exception:
+        return False
+
+def reset_driver(driver):
+    """
+    Close extra windows, clear the cookies of the browser and the storage of every origin the capture reached, and leave
+    the browser on a blank page.
+    :return: False when the browser could not be reset and should not be reused.
+    """
+    try:
+        handles = driver.window_handles
+        origins = set()
+        for handle in reversed(handles):
+            driver.switch_to.window(handle)
+            origins.update(page_origins(driver))
+            if handle != handles[0]:
+                driver.close()
+        driver.switch_to.window(handles[0])
+        for cookie in driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", []):
+            domain = cookie["domain"].lstrip(".")
+            origins.update(("https://" + domain, "http://" + domain))
+        driver.get("about:blank")
+        # WebDriver only reaches the current origin, the storage of the other ones, IndexedDB and service workers need CDP
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        for origin in sorted(origins):
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        return True
+    except Exception:
+        return False
+
+def page_origins(driver):
+    """
+    The origin of the page in the current window and of every resource and frame it loaded, sessionStorage of the page is cleared on the way.
+    """
+    try:
+        return driver.execute_script(
+            "try { window.sessionStorage.clear(); } catch (e) {}"
+            "var origins = [location.origin];"
+            "performance.getEntriesByType('resource').forEach(function(entry) {"
+            " try { origins.push(new URL(entry.name).origin); } catch (e) {} });"
+            "return origins.filter(function(origin) { return /^https?:/.test(origin); });") or []
+    except Exception:
+        # pages such as file:// have nothing to clear
+        return []
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+@functools.lru_cache(maxsize=1)
+def find_chromedriver():
+    chromedriver = shutil.which("chromedriver")
     if not chromedriver:
         if os.path.exists('/usr/bin/chromedriver'):
             chromedriver = '/usr/bin/chromedriver'
@@ -102,12 +550,17 @@ def make_driver():
                 raise FileNotFoundError("Chrome driver not found")
             except:
                 raise IOError("Chrome driver not found")
+    return chromedriver
 
+def make_driver(strategy="normal"):
+    chromedriver = find_chromedriver()
+    capabilities = DesiredCapabilities.CHROME.copy()
+    capabilities["pageLoadStrategy"] = strategy
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--window-size=1920,1080")
-    return webdriver.Chrome(executable_path=chromedriver, options=chrome_options)
+    chrome_options.add_argument("--window-size=" + WINDOW_SIZE)
+    return webdriver.Chrome(executable_path=chromedriver, options=chrome_options, desired_capabilities=capabilities)
 
 
 def enable_download_in_headless_chrome(browser, download_dir):
@@ -117,10 +570,110 @@ def enable_download_in_headless_chrome(browser, download_dir):
     browser.execute("send_command", params)
 
 
-def get_screenshot_for_html_file(driver, html_file_path, target_path):
-    driver.get('file://' + html_file_path)
-    return driver.save_screenshot(target_path)
+def get_screenshot_for_html_file(driver, html_file_path, target_paths, options):
+    return render_and_capture(driver, lambda: driver.get('file://' + html_file_path), target_paths, options)
+
+def get_screenshot_for_html(driver, html, target_paths, options):
+    def load():
+        # the HTML is set straight into the blank page, no temporary file is written
+        driver.get('about:blank')
+        frame_id = driver.execute_cdp_cmd("Page.getFrameTree", {})["frameTree"]["frame"]["id"]
+        driver.execute_cdp_cmd("Page.setDocumentContent", {"frameId": frame_id, "html": html})
+    return render_and_capture(driver, load, target_paths, options)
     
-def get_screenshot_for_url(driver, url, target_path):
-    driver.get(url)
-    return driver.save_screenshot(target_path)
+def get_screenshot_for_url(driver, url, target_paths, options):
+    return render_and_capture(driver, lambda: driver.get(url), target_paths, options)
+
+def render_and_capture(driver, load, target_paths, options):
+    """
+    Load the page, wait for it as the render mode says, capture it once per viewport and report how long each step took.
+    Past the deadline the page is stopped and what has rendered so far is captured.
+    """
+    start = time.time()
+    timed_out = "false"
+    if options["blocked_urls"]:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": options["blocked_urls"]})
+    if options["deadline"]:
+        driver.set_page_load_timeout(options["deadline"])
+    try:
+        try:
+            load()
+        except TimeoutException:
+            timed_out = "true"
+        loaded = time.time()
+        if options["render_mode"] == "fast" and timed_out == "false":
+            if not wait_for_network_idle(driver, start + options["deadline"], options["idle_ms"] / 1000.0):
+                timed_out = "true"
+        if timed_out == "true":
+            driver.execute_script("window.stop();")
+        rendered = time.time()
+        timing = page_timing(driver)
+        if options["viewports"]:
+            try:
+                for target_path, viewport in zip(target_paths, options["viewports"]):
+                    # the page reflows to the new metrics without loading again
+                    driver.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", {
+                        "width": viewport["width"], "height": viewport["height"],
+                        "deviceScaleFactor": viewport["device_scale_factor"], "mobile": viewport["mobile"]})
+                    driver.execute_async_script("requestAnimationFrame(function() { requestAnimationFrame(arguments[0]); });")
+                    capture_screenshot(driver, target_path, options)
+            finally:
+                driver.execute_cdp_cmd("Emulation.clearDeviceMetricsOverride", {})
+        else:
+            capture_screenshot(driver, target_paths[0], options)
+    finally:
+        if options["blocked_urls"]:
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+        if options["deadline"]:
+            driver.set_page_load_timeout(DEFAULT_PAGE_LOAD_TIMEOUT)
+    timing.update({"cached": "false", "timed_out": timed_out, "load_ms": int((loaded - start) * 1000),
+                   "idle_wait_ms": int((rendered - loaded) * 1000), "capture_ms": int((time.time() - rendered) * 1000),
+                   "total_ms": int((time.time() - start) * 1000)})
+    return timing
+
+def wait_for_network_idle(driver, deadline_at, idle_seconds):
+    """
+    Poll the number of finished resource loads and consider the network idle once it has not changed for idle_seconds.
+    :return: False when the deadline came first.
+    """
+    last_count = -1
+    stable_since = time.time()
+    while time.time() < deadline_at:
+        state, count = driver.execute_script("return [document.readyState, performance.getEntriesByType('resource').length];")
+        now = time.time()
+        if count != last_count:
+            last_count = count
+            stable_since = now
+        elif state != "loading" and now - stable_since >= idle_seconds:
+            return True
+        time.sleep(0.1)
+    return False
+
+def page_timing(driver):
+    # navigation timings of the page itself, in milliseconds since the navigation started
+    return driver.execute_script(
+        "var t = performance.timing;"
+        "return {dom_content_loaded_ms: t.domContentLoadedEventEnd ? t.domContentLoadedEventEnd - t.navigationStart : null,"
+        " load_event_ms: t.loadEventEnd ? t.loadEventEnd - t.navigationStart : null,"
+        " resources: performance.getEntriesByType('resource').length};") or {}
+
+def capture_screenshot(driver, target_path, options):
+    """
+    Capture with Page.captureScreenshot in the requested format, quality and region, and write the image to target_path.
+    """
+    params = {"format": options["format"]}
+    if options["format"] != "png":
+        params["quality"] = max(0, min(100, options["quality"]))
+    if options["full_page"]:
+        metrics = driver.execute_cdp_cmd("Page.getLayoutMetrics", {})
+        size = metrics.get("cssContentSize") or metrics["contentSize"]
+        params["clip"] = {"x": 0, "y": 0, "width": size["width"], "height": size["height"], "scale": 1}
+        params["captureBeyondViewport"] = True
+    elif options["clip"]:
+        x, y, width, height = options["clip"]
+        params["clip"] = {"x": x, "y": y, "width": width, "height": height, "scale": 1}
+    data = driver.execute_cdp_cmd("Page.captureScreenshot", params)["data"]
+    with open(target_path, "wb") as image_file:
+        image_file.write(base64.b64decode(data))
+    return True
@@ -0,0 +1,198 @@
+"""
+Benchmarks for the MS Word integration. This is not part of the integration, run it next to main.py
+with lhub_integ and the requirements installed.
+
+    python benchmark.py build --sections 50 100 300    one action per change against one Build Document call
+    python benchmark.py table --rows 1000 10000        filling a table cell by cell against the bulk table writer
+    python benchmark.py merge --records 100 1000       one Apply Merge Fields call per record against one batch merge
+    python benchmark.py template                       loading a merge template by parsing it, from disk and from memory
+    python benchmark.py image --screenshots 10         report size and time with full resolution and prepared screenshots
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import main
+
+WORDS = ("alert user login failed from host please review attached evidence account password reset "
+         "containment eradication recovery timeline analyst escalated").split()
+
+
+def section_operations(sections):
+    """
+    An incident report with a heading, two paragraphs and a small table per section.
+    """
+    operations = []
+    for i in range(sections):
+        operations.append({"type": "heading", "text": "Section {}".format(i + 1), "level": 1})
+        for j in range(2):
+            operations.append({"type": "paragraph", "text": ' '.join(WORDS[(i + j + k) % len(WORDS)] for k in range(60))})
+        operations.append({"type": "table", "headers": ["host", "user", "action"],
+                           "rows": [["host{}".format(k), WORDS[k], WORDS[-k - 1]] for k in range(5)]})
+    return operations
+
+
+def per_action(doc_file, operations):
+    # the way a playbook builds the report today, every step opens and saves the whole document
+    main.CreateNewFile(doc_file, "Incident Report")
+    for operation in operations:
+        if operation["type"] == "heading":
+            main.AppendHeading(doc_file, operation["text"])
+        elif operation["type"] == "paragraph":
+            main.AppendText(doc_file, operation["text"])
+        elif operation["type"] == "table":
+            main.AppendTable(doc_file, len(operation["headers"]), ','.join(operation["headers"]), repr(operation["rows"]))
+
+
+def batched(doc_file, operations):
+    main.BuildDocument(doc_file, json.dumps([{"type": "heading", "text": "Incident Report", "level": 0}] + operations))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def run_build(args):
+    print("{:>9} {:>11} {:>15} {:>15} {:>9} {:>10}".format("sections", "operations", "per-action ms", "build ms", "speedup", "size KB"))
+    for sections in args.sections:
+        operations = section_operations(sections)
+        per_action_time = timed(per_action, "per_action.docx", operations)
+        build_time = timed(batched, "build.docx", operations)
+        size = os.path.getsize(main.base_path + "build.docx")
+        print("{:>9} {:>11} {:>15.0f} {:>15.0f} {:>8.1f}x {:>10.0f}".format(
+            sections, len(operations), per_action_time * 1000, build_time * 1000, per_action_time / build_time, size / 1000))
+        os.remove(main.base_path + "build.docx")
+
+
+def cell_by_cell(document, headers, rows, style):
+    # the original Append Table loop, one add_row and one cell.text per cell
+    table = document.add_table(rows=1, cols=len(headers))
+    table.style = style
+    for col, header in enumerate(headers):
+        table.rows[0].cells[col].text = header
+    for r in rows:
+        row = table.add_row()
+        for col, c in enumerate(r):
+            row.cells[col].text = c
+
+
+def run_table(args):
+    headers = ["host", "user", "action", "result", "count"]
+    print("{:>9} {:>9} {:>17} {:>9} {:>9}".format("rows", "cells", "cell-by-cell ms", "bulk ms", "speedup"))
+    for count in args.rows:
+        rows = [["host{}".format(i), WORDS[i % len(WORDS)], WORDS[-(i % len(WORDS)) - 1], "ok", str(i)] for i in range(count)]
+        slow = timed(cell_by_cell, main.Document(), headers, rows, "Light List Accent 1") if count <= args.max_slow_rows else None
+        bulk = timed(main.add_table, main.Document(), len(headers), headers, rows, "Light List Accent 1")
+        print("{:>9} {:>9} {:>17} {:>9.0f} {:>9}".format(
+            count, count * len(headers), "{:.0f}".format(slow * 1000) if slow else "-", bulk * 1000,
+            "{:.1f}x".format(slow / bulk) if slow else "-"))
+
+
+def merge_template(path):
+    """
+    A one page letter with a few merge fields.
+    """
+    document = main.Document()
+    document.add_heading("Security notice", 0)
+    for field in ("name", "email", "incident"):
+        paragraph = document.add_paragraph(field + ": ")
+        paragraph._p.append(main.parse_xml('<w:fldSimple {} w:instr=" MERGEFIELD {} "><w:r><w:t>«{}»</w:t></w:r></w:fldSimple>'.format(
+            main.nsdecls('w'), field, field)))
+    for i in range(20):
+        document.add_paragraph(' '.join(WORDS[(i + k) % len(WORDS)] for k in range(40)))
+    document.save(path)
+
+
+def run_merge(args):
+    main.events_base = main.base_path
+    merge_template(main.base_path + "template.docx")
+    print("{:>9} {:>14} {:>14} {:>9} {:>14} {:>9}".format("records", "per-call ms", "per_file ms", "speedup", "combined ms", "speedup"))
+    for count in args.records:
+        records = [{"name": "user{}".format(i), "email": "user{}@example.com".format(i), "incident": str(i)} for i in range(count)]
+        per_call = timed(lambda: [main.ApplyMergeFields("template.docx", "call-{}.docx".format(i), json.dumps(record))
+                                  for i, record in enumerate(records)])
+        os.environ["MERGE_OUTPUT"] = "per_file"
+        per_file = timed(main.ApplyMergeFieldsBatch, "template.docx", "file.docx", json.dumps(records))
+        os.environ["MERGE_OUTPUT"] = "combined"
+        combined = timed(main.ApplyMergeFieldsBatch, "template.docx", "combined.docx", json.dumps(records))
+        print("{:>9} {:>14.0f} {:>14.0f} {:>8.1f}x {:>14.0f} {:>8.1f}x".format(
+            count, per_call * 1000, per_file * 1000, per_call / per_file, combined * 1000, per_call / combined))
+
+
+def run_template(args):
+    path = main.base_path + "template.docx"
+    merge_template(path)
+    main.load_template(path)
+    parse = best_of(lambda: main.MailMerge(path).close())
+    disk = best_of(lambda: main.template_cache.clear() or main.load_template(path))
+    memory = best_of(lambda: main.load_template(path))
+    print("{:>10} {:>10} {:>12}".format("parse ms", "disk ms", "memory ms"))
+    print("{:>10.2f} {:>10.2f} {:>12.4f}".format(parse * 1000, disk * 1000, memory * 1000))
+    print(main.TemplateCacheStats())
+
+
+def screenshot(path, seed):
+    """
+    A 1920x1080 PNG that looks like a page: a coloured banner, a photo and lines of text.
+    """
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (1920, 1080), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 1920, 120), fill=(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+    photo = Image.merge("RGB", [Image.effect_noise((580, 400), 40 + 10 * channel) for channel in range(3)])
+    image.paste(photo, (1300, 160))
+    for y in range(160, 1060, 18):
+        draw.text((40, y), ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 30))), fill=(30, 30, 30))
+    image.save(path)
+
+
+def run_image(args):
+    # half of the screenshots repeat an earlier one, as when the same page is captured twice
+    for i in range(args.screenshots):
+        if i % 2:
+            shutil.copy(main.base_path + "shot{}.png".format(i - 1), main.base_path + "shot{}.png".format(i))
+        else:
+            screenshot(main.base_path + "shot{}.png".format(i), i)
+    operations = [{"type": "image", "file_id": "shot{}.png".format(i)} for i in range(args.screenshots)]
+    print("{:>22} {:>10} {:>10}".format("settings", "time ms", "size KB"))
+    for dpi, quality in ((0, 0), (150, 0), (150, 80), (96, 80)):
+        os.environ["IMAGE_DPI"] = str(dpi)
+        os.environ["IMAGE_JPEG_QUALITY"] = str(quality)
+        main.image_cache.clear()
+        elapsed = timed(main.BuildDocument, "images.docx", json.dumps(operations))
+        print("{:>22} {:>10.0f} {:>10.0f}".format("dpi={} jpeg={}".format(dpi or "full", quality or "no"), elapsed * 1000,
+                                                 os.path.getsize(main.base_path + "images.docx") / 1000))
+        os.remove(main.base_path + "images.docx")
+
+
+def best_of(func, repeat=20):
+    return min(timed(func) for _ in range(repeat))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MS Word benchmarks")
+    parser.add_argument("mode", choices=["build", "table", "merge", "template", "image"])
+    parser.add_argument("--sections", type=int, nargs="+", default=[25, 50, 100], help="report sizes to time")
+    parser.add_argument("--rows", type=int, nargs="+", default=[300, 1000, 5000], help="table sizes to time")
+    parser.add_argument("--records", type=int, nargs="+", default=[100, 500], help="merge batch sizes to time")
+    parser.add_argument("--screenshots", type=int, default=10, help="screenshots added to the image report")
+    parser.add_argument("--max-slow-rows", type=int, default=300, help="largest table filled cell by cell, its time grows with the square of the rows")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main.base_path = tempfile.mkdtemp() + "/"
+    main.TEMPLATE_CACHE_DIR = main.base_path + ".template_cache/"
+    try:
+        {"build": run_build, "table": run_table, "merge": run_merge, "template": run_template, "image": run_image}[args.mode](args)
+    finally:
+        shutil.rmtree(main.base_path)
@@ -7,15 +7,57 @@ logoUrl: https://upload.wikimedia.org/wikipedia/commons/8/88/MS_word_DOC_icon.sv
 from mailmerge import MailMerge
 from docx import Document
 from docx.shared import Inches
+from docx.enum.text import WD_BREAK
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
+from lxml import etree
+from zipfile import ZipFile, BadZipFile
+from collections import OrderedDict
+from PIL import Image, ImageOps
+import hashlib
+import io
 import json
 import ast
+import csv
+import itertools
+import os
+import re
+import tempfile
+import threading
 from lhub_integ.params import ConnectionParam, ActionParam, InputType, JinjaTemplatedStr, DataType
 from lhub_integ import action
 
-STYLE = ActionParam("STYLE", description="Pick a style, refer to Word table styles for more details", input_type=InputType.SELECT, options=['Light List Accent 1','Light Grid Accent 1','Light Shading Accent 1'], default='Light List Accent 1', action="AppendTable")
+STYLE = ActionParam("STYLE", description="Pick a style, refer to Word table styles for more details", input_type=InputType.SELECT, options=['Light List Accent 1','Light Grid Accent 1','Light Shading Accent 1'], default='Light List Accent 1', action=["AppendTable","AppendTableBulk","BuildDocument"])
+TABLE_FORMAT = ActionParam("TABLE_FORMAT", description="How the rows are given: a JSON array, or the file_id of a CSV or NDJSON file", input_type=InputType.SELECT, options=['json','csv','ndjson'], default='json', action="AppendTableBulk")
+RECORDS_FORMAT = ActionParam("RECORDS_FORMAT", description="How the merge records are given: a JSON array of objects, or the file_id of an NDJSON file", input_type=InputType.SELECT, options=['json','ndjson'], default='json', action="ApplyMergeFieldsBatch")
+MERGE_OUTPUT = ActionParam("MERGE_OUTPUT", description="combined writes one document with a page per record, per_file writes one document per record", input_type=InputType.SELECT, options=['combined','per_file'], default='combined', action="ApplyMergeFieldsBatch")
+MERGE_WORKERS = ActionParam("MERGE_WORKERS", description="Number of worker processes writing documents with per_file output, 0 uses the number of CPUs and 1 writes them in place", optional=True, input_type=InputType.TEXT, data_type=DataType.INT, default="0", action="ApplyMergeFieldsBatch")
+IMAGE_DPI = ActionParam("IMAGE_DPI", description="Images with more pixels than their display width needs at this DPI are downscaled, 0 keeps the full resolution", optional=True, input_type=InputType.TEXT, data_type=DataType.INT, default="150", action=["AppendImage","BuildDocument"])
+IMAGE_JPEG_QUALITY = ActionParam("IMAGE_JPEG_QUALITY", description="Recompress images without transparency to JPEG at this quality, 1 to 95, 0 keeps their format", optional=True, input_type=InputType.TEXT, data_type=DataType.INT, default="0", action=["AppendImage","BuildDocument"])
 
 base_path = "/opt/files/shared/integrationsFiles/"
 events_base = "/opt/files/service/event_files/"
+# width of pictures in inches when none is given
+IMAGE_WIDTH = 6.25
+# prepared images kept by content hash and settings
+IMAGE_CACHE_SIZE = 32
+# EXIF orientations that swap width and height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+# table rows turned into XML at a time
+TABLE_CHUNK_ROWS = 1000
+# pre-processed merge templates, read on cold starts instead of parsing the template again
+TEMPLATE_CACHE_DIR = base_path + ".template_cache/"
+# per_file batches smaller than this are written in place, starting worker processes costs more than they save
+MERGE_POOL_MIN_RECORDS = 500
+# per_file merge records written by a worker process at a time
+MERGE_CHUNK_RECORDS = 50
+# WordprocessingML namespace of the parts MailMerge parses
+W_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# characters that are not allowed in XML text
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
 @action(name="Create New File")
 def CreateNewFile(DocFile, Title):
@@ -42,7 +84,7 @@ def AppendImage(DocFile, ImageFile):
     :return: An instance to the file to be manipulated.
     """
     document = Document(base_path+DocFile)
-    document.add_picture(base_path+ImageFile, width=Inches(6.25))
+    add_image(document, ImageFile)
     document.save(base_path+DocFile)
     return {
         "has_error":"false", "file_name":DocFile
@@ -90,25 +132,57 @@ def AppendTable(DocFile, Columns:int, Headers, RowArray: JinjaTemplatedStr):
     :return: An instance to the file to be manipulated.
     """
     document = Document(base_path+DocFile)
-    table = document.add_table(rows=1, cols=Columns)
-    table.style=STYLE.read()
-    headers = Headers.split(',')
-    row = table.rows[0]
-    col = 0
-    for header in headers :
-        row.cells[col].text = header
-        col = col + 1
-    data = ast.literal_eval(RowArray)
-    for r in data :
-        row = table.add_row()
-        col = 0
-        for c in r :
-            row.cells[col].text = c
-            col = col + 1
+    add_table(document, Columns, Headers.split(','), ast.literal_eval(RowArray), STYLE.read())
     document.save(base_path+DocFile)
     return {
         "has_error":"false", "file_name":DocFile
     }
+
+@action(name="Append Table Bulk")
+def AppendTableBulk(DocFile, Headers, Rows:JinjaTemplatedStr):
+    """
+    The action allows you to append a large table onto the word document. The table is written in one pass, so tens of thousands of cells take seconds.
+    :param DocFile: The column contains file name.
+    :param Headers: comma separated column headers either from a parent column, or just ="col1,col2,etc". When empty they are taken from the first CSV row or the keys of the first JSON object.
+    :optional Headers: True
+    :param Rows: The column contains a JSON array of rows, each a list of cells or an object keyed by header, for example: [["a","b"],["c","d"]]. With TABLE_FORMAT csv or ndjson, the file_id of the file holding the rows.
+    :return: An instance to the file to be manipulated.
+    """
+    try:
+        columns, headers, rows = read_table(Rows, TABLE_FORMAT.read(), Headers.split(',') if Headers else [])
+        document = Document(base_path+DocFile)
+        row_count = add_table(document, columns, headers, rows, STYLE.read())
+    except (ValueError, OSError) as e:
+        return {"has_error":"true", "error_msg":str(e), "file_name":DocFile}
+    document.save(base_path+DocFile)
+    return {
+        "has_error":"false", "file_name":DocFile, "rows":row_count
+    }
+
+@action(name="Build Document")
+def BuildDocument(DocFile, Operations:JinjaTemplatedStr):
+    """
+    This action applies a list of operations to the word document in one go, the document is opened and saved only once. A new document is created when the file does not exist yet.
+    :param DocFile: The column contains file name.
+    :param Operations: The column contains a JSON list of operations applied in order, for example: [{"type": "heading", "text": "Summary", "level": 1}, {"type": "paragraph", "text": "..."}, {"type": "image", "file_id": "...", "width": 6.25}, {"type": "table", "headers": ["col1", "col2"], "rows": [["a", "b"]], "style": "Light Grid Accent 1"}, {"type": "table", "file_id": "...", "format": "csv"}, {"type": "page_break"}]
+    :return: An instance to the file to be manipulated.
+    """
+    try:
+        operations = json.loads(Operations)
+    except ValueError as e:
+        return {"has_error":"true", "error_msg":"Operations is not valid JSON: " + str(e)}
+    if isinstance(operations, dict):
+        operations = [operations]
+    document = Document(base_path+DocFile) if os.path.exists(base_path+DocFile) else Document()
+    for index, operation in enumerate(operations):
+        try:
+            apply_operation(document, operation)
+        except Exception as e:
+            return {"has_error":"true", "error_msg":"Operation {} failed: {}".format(index, e), "file_name":DocFile}
+    document.save(base_path+DocFile)
+    return {
+        "has_error":"false", "file_name":DocFile, "operations":len(operations)
+    }
     
 @action(name="Apply Merge Fields")
 def ApplyMergeFields(DocFile, NewFile, MergeJSON):
@@ -119,10 +193,415 @@ def ApplyMergeFields(DocFile, NewFile, MergeJSON):
     :param MergeJSON: The column contains the JSON dictionary of the merge fields. This should match the template.
     :return: An instance to the file to be manipulated.
     """
-    document = MailMerge(events_base+DocFile)
+    document = merge_copy(load_template(events_base+DocFile))
     mergeFields = json.loads(MergeJSON)
     document.merge_pages([mergeFields])
     document.write(base_path+NewFile)
     return {
         "has_error":"false", "file_name":NewFile
-    }    
+    }
+
+
+@action(name="Apply Merge Fields Batch")
+def ApplyMergeFieldsBatch(DocFile, NewFile, Records):
+    """
+    This action populates a word template file with MergeFields once per record, the template is parsed only once per worker process. The template file must be preloaded into the system under the service/event_files directory.
+    :param DocFile: The column contains file name.
+    :param NewFile: The column contains new file name. With per_file output the files are named after it with the record number, eg, letter-1.docx, letter-2.docx
+    :param Records: The column contains a JSON list of merge field dictionaries, or with RECORDS_FORMAT ndjson the file_id of a file with one dictionary per line.
+    :return: The generated file names.
+    """
+    try:
+        if RECORDS_FORMAT.read() == "ndjson":
+            records = list(read_table_file(base_path+Records, "ndjson"))
+        else:
+            records = json.loads(Records)
+    except (ValueError, OSError) as e:
+        return {"has_error":"true", "error_msg":"Records could not be read: " + str(e)}
+    if not isinstance(records, list) or not all(valid_record(record) for record in records):
+        return {"has_error":"true", "error_msg":"Records must be a list of merge field dictionaries, with a list of dictionaries for table rows"}
+    template = load_template(events_base+DocFile)
+    if MERGE_OUTPUT.read() == "per_file":
+        stem, extension = os.path.splitext(NewFile)
+        file_names = ["{}-{}{}".format(stem, index + 1, extension or ".docx") for index in range(len(records))]
+        jobs = [(record, base_path+file_name) for record, file_name in zip(records, file_names)]
+        workers = min(MERGE_WORKERS.read() or os.cpu_count() or 1, len(jobs) // MERGE_CHUNK_RECORDS)
+        if workers <= 1 or len(jobs) < MERGE_POOL_MIN_RECORDS:
+            for record, target_path in jobs:
+                merge_to_file(template, record, target_path)
+        else:
+            chunks = [jobs[start:start + MERGE_CHUNK_RECORDS] for start in range(0, len(jobs), MERGE_CHUNK_RECORDS)]
+            # forked workers must not read the template zip through the file handle of the cached copy
+            with ProcessPoolExecutor(max_workers=workers, initializer=template_cache.clear) as executor:
+                list(executor.map(merge_file_chunk, itertools.repeat(events_base+DocFile), chunks))
+    else:
+        merge_combined(template, records).write(base_path+NewFile)
+        file_names = [NewFile]
+    return {
+        "has_error":"false", "file_name":file_names[0] if file_names else None, "file_names":file_names, "records":len(records)
+    }
+
+@action(name="Template Cache Stats")
+def TemplateCacheStats():
+    """
+    Report the merge template cache counters of this worker. Hits are served from memory, disk hits from the pre-processed copy and misses parse the template.
+    :return: hits, disk hits, misses and the number of templates held in memory.
+    """
+    with template_cache_lock:
+        return dict(template_cache_stats, size=len(template_cache))
+
+
+def apply_operation(document, operation):
+    """
+    Apply one Build Document operation to the in-memory document.
+    """
+    kind = operation.get("type")
+    if kind == "heading":
+        document.add_heading(operation.get("text", ""), operation.get("level", 1))
+    elif kind == "paragraph":
+        document.add_paragraph(operation.get("text", ""), operation.get("style"))
+    elif kind == "image":
+        add_image(document, operation["file_id"], operation.get("width", IMAGE_WIDTH))
+    elif kind == "table":
+        if "file_id" in operation:
+            columns, headers, rows = read_table(operation["file_id"], operation.get("format", "csv"), operation.get("headers", []))
+        else:
+            columns, headers, rows = read_table(operation.get("rows", []), "json", operation.get("headers", []))
+        add_table(document, operation.get("columns") or columns, headers, rows, operation.get("style") or STYLE.read())
+    elif kind == "page_break":
+        document.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+    else:
+        raise ValueError("unknown operation type {}".format(kind))
+
+
+# prepared images by (content hash, width, DPI, quality), least recently used first
+image_cache = OrderedDict()
+
+
+def add_image(document, image_file, width=IMAGE_WIDTH):
+    """
+    Add a picture displayed at the width in inches, prepared by prepare_image first. python-docx stores pictures by
+    hash, so the same picture added again is one image part in the package.
+    """
+    with open(base_path+image_file, "rb") as image:
+        data = image.read()
+    document.add_picture(io.BytesIO(prepare_image(data, width, IMAGE_DPI.read(), IMAGE_JPEG_QUALITY.read())), width=Inches(width))
+
+
+def prepare_image(data, width, dpi, quality):
+    key = (hashlib.sha256(data).hexdigest(), width, dpi, quality)
+    if key in image_cache:
+        image_cache.move_to_end(key)
+        return image_cache[key]
+    prepared = shrink_image(data, width, dpi, quality)
+    image_cache[key] = prepared
+    if len(image_cache) > IMAGE_CACHE_SIZE:
+        image_cache.popitem(last=False)
+    return prepared
+
+
+def shrink_image(data, width, dpi, quality):
+    """
+    Downscale the image to width * dpi pixels wide and recompress it to JPEG when a quality is given and it has no
+    transparency. Images that are small enough, animated or not readable by Pillow are returned as they are.
+    :return: the image bytes, whichever of the original and the prepared image is smaller
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, "is_animated", False):
+            return data
+        pixels = image.height if image.getexif().get(0x0112, 1) in ROTATED_ORIENTATIONS else image.width
+        max_pixels = int(width * dpi)
+        resize = dpi > 0 and pixels > max_pixels
+        jpeg = quality > 0 and is_opaque(image)
+        if not resize and not jpeg:
+            return data
+        image_format = image.format
+        image = ImageOps.exif_transpose(image)
+        if resize:
+            image = image.resize((max_pixels, max(1, round(image.height * max_pixels / image.width))), Image.LANCZOS)
+        output = io.BytesIO()
+        if jpeg:
+            image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True)
+        elif image_format == "JPEG":
+            image.save(output, "JPEG", quality=95)
+        else:
+            image.save(output, "PNG")
+    except (OSError, ValueError):
+        return data
+    prepared = output.getvalue()
+    return prepared if len(prepared) < len(data) else data
+
+
+def is_opaque(image):
+    if image.mode in ("RGBA", "LA"):
+        return image.getchannel("A").getextrema()[0] == 255
+    if image.mode == "P":
+        return "transparency" not in image.info
+    return True
+
+
+def read_table(rows_input, table_format, headers):
+    """
+    Read the rows of a JSON array, or of a CSV or NDJSON file_id, as lists of cells. Without headers they are taken from the
+    first CSV row or the keys of the first JSON object, and the number of columns from the headers or the first row.
+    :return: (number of columns, headers, iterator over the rows)
+    """
+    if table_format == "json":
+        rows = iter(json.loads(rows_input) if isinstance(rows_input, str) else rows_input)
+    else:
+        rows = read_table_file(base_path+rows_input, table_format)
+    first = next(rows, None)
+    if first is None:
+        return len(headers) or 1, headers, rows
+    if not headers and isinstance(first, dict):
+        headers = list(first)
+    elif not headers and table_format == "csv":
+        headers = first
+        first = None
+    rows = itertools.chain([first] if first is not None else [], rows)
+    columns = len(headers) or len(first)
+    return columns, headers, ([row.get(header, "") for header in headers] if isinstance(row, dict) else row for row in rows)
+
+
+def read_table_file(path, table_format):
+    with open(path, newline="", encoding="utf-8-sig") as rows_file:
+        if table_format == "csv":
+            for row in csv.reader(rows_file):
+                yield row
+        else:
+            for line in rows_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def add_table(document, columns, headers, rows, style):
+    """
+    Append a table. The rows are turned into XML TABLE_CHUNK_ROWS at a time rather than filled cell by cell through
+    python-docx, which keeps the cost linear in the number of cells.
+    :return: number of rows written below the headers
+    """
+    table = document.add_table(rows=0, cols=columns)
+    table.style=style
+    tbl = table._tbl
+    # column widths in twips, as python-docx sets them on the cells it creates
+    widths = [(gridCol.w.emu if gridCol.w is not None else 0) // 635 for gridCol in tbl.tblGrid.gridCol_lst]
+    if headers:
+        rows = itertools.chain([headers], rows)
+    row_count = 0
+    chunk = []
+    for row in rows:
+        if len(row) > columns:
+            raise ValueError("A row has {} cells but the table has {} columns".format(len(row), columns))
+        chunk.append(row_xml(row, widths))
+        row_count = row_count + 1
+        if len(chunk) == TABLE_CHUNK_ROWS:
+            append_rows(tbl, chunk)
+            chunk = []
+    append_rows(tbl, chunk)
+    return row_count - 1 if headers else row_count
+
+
+def append_rows(tbl, chunk):
+    if chunk:
+        tbl.extend(list(parse_xml('<w:tbl {}>{}</w:tbl>'.format(nsdecls('w'), ''.join(chunk)))))
+
+
+def row_xml(row, widths):
+    cells = []
+    for col, width in enumerate(widths):
+        cells.append('<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{}"/></w:tcPr>{}</w:tc>'.format(
+            width, paragraph_xml(row[col] if col < len(row) else None)))
+    return '<w:tr>' + ''.join(cells) + '</w:tr>'
+
+
+def paragraph_xml(value):
+    # same runs as setting cell.text, tabs and line breaks become w:tab and w:br
+    text = INVALID_XML_CHARS.sub('', '' if value is None else str(value))
+    if not text:
+        return '<w:p/>'
+    text = escape(text).replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+    text = re.sub('\r\n?|\n', '</w:t><w:br/><w:t xml:space="preserve">', text)
+    return '<w:p><w:r><w:t xml:space="preserve">{}</w:t></w:r></w:p>'.format(text)
+
+
+# parsed templates by path, with the mtime and size of the file they were parsed from
+template_cache = {}
+template_cache_lock = threading.Lock()
+template_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+
+def load_template(template_path):
+    """
+    The parsed template, kept in memory as long as the file keeps the same mtime and size. On a cold start it is read
+    from the pre-processed copy in TEMPLATE_CACHE_DIR, and only parsed when there is none for this version of the file.
+    The template must not be merged into, use merge_copy.
+    """
+    stat = os.stat(template_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with template_cache_lock:
+        cached = template_cache.get(template_path)
+        if cached is not None and cached[0] == version:
+            template_cache_stats["hits"] += 1
+            return cached[1]
+    cache_path = template_cache_path(template_path, version)
+    template = read_processed_template(template_path, cache_path)
+    if template is None:
+        template = MailMerge(template_path)
+        write_processed_template(template, cache_path)
+        counter = "misses"
+    else:
+        counter = "disk_hits"
+    with template_cache_lock:
+        template_cache_stats[counter] += 1
+        cached = template_cache.get(template_path)
+        if cached is not None and cached[0] == version:
+            # another thread loaded the same version first, keep that one
+            stale, template = template, cached[1]
+        else:
+            stale = cached[1] if cached is not None else None
+            template_cache[template_path] = (version, template)
+    if stale is not None:
+        # the zip of an older version would otherwise stay open for the life of the worker
+        stale.close()
+    return template
+
+
+def template_cache_path(template_path, version):
+    return "{}{}-{}-{}.zip".format(TEMPLATE_CACHE_DIR, hashlib.sha256(template_path.encode("utf-8")).hexdigest()[:32], *version)
+
+
+def read_processed_template(template_path, cache_path):
+    """
+    Rebuild a MailMerge from the parts saved by write_processed_template, skipping the search for merge fields.
+    :return: the template, or None when there is no usable copy
+    """
+    try:
+        processed = ZipFile(cache_path)
+    except (OSError, BadZipFile):
+        return None
+    with processed:
+        template = MailMerge.__new__(MailMerge)
+        template.zip = ZipFile(template_path)
+        template.parts = {}
+        template.settings = None
+        template._settings_info = None
+        template.remove_empty_tables = False
+        try:
+            for name in processed.namelist():
+                kind, file_name = name.split("/", 1)
+                tree = etree.ElementTree(etree.fromstring(processed.read(name)))
+                if kind == "settings":
+                    template._settings_info, template.settings = template.zip.getinfo(file_name), tree
+                else:
+                    template.parts[template.zip.getinfo(file_name)] = tree
+        except (KeyError, ValueError, BadZipFile, etree.XMLSyntaxError):
+            template.close()
+            return None
+    return template
+
+
+def write_processed_template(template, cache_path):
+    """
+    Save the parts of a parsed template with its merge fields already found, and remove the copies of older versions.
+    Failing to save only costs a parse on the next cold start.
+    """
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=TEMPLATE_CACHE_DIR)
+        with os.fdopen(handle, "wb") as temp_file, ZipFile(temp_file, "w") as processed:
+            for zi, part in template.parts.items():
+                processed.writestr("parts/" + zi.filename, etree.tostring(part.getroot()))
+            if template.settings is not None:
+                processed.writestr("settings/" + template._settings_info.filename, etree.tostring(template.settings.getroot()))
+        os.replace(temp_path, cache_path)
+        prefix = os.path.basename(cache_path).split("-")[0] + "-"
+        for name in os.listdir(TEMPLATE_CACHE_DIR):
+            if name.startswith(prefix) and TEMPLATE_CACHE_DIR + name != cache_path:
+                os.remove(TEMPLATE_CACHE_DIR + name)
+    except OSError:
+        pass
+
+
+def merge_copy(template):
+    """
+    A copy of the parsed template that can be merged without changing it, the zip with the other parts is shared.
+    """
+    document = copy(template)
+    document.parts = {zi: deepcopy(part) for zi, part in template.parts.items()}
+    document.settings = deepcopy(template.settings)
+    return document
+
+
+def valid_record(record):
+    return isinstance(record, dict) and all(
+        all(isinstance(row, dict) for row in value) for value in record.values() if isinstance(value, list))
+
+
+def merge_values(record):
+    # merge fields take text, or a list of row objects for tables
+    return {field: value if isinstance(value, list) or value is None else str(value) for field, value in record.items()}
+
+
+def merge_combined(template, records):
+    """
+    One document with the body of the template merged once per record, separated by page breaks. Every record is merged
+    into its own copy of the body, table rows included, before the copy is added to the document.
+    """
+    document = merge_copy(template)
+    for part in document.parts.values():
+        body = part.getroot().find(W_NAMESPACE + "body")
+        if body is None:
+            continue
+        section = body.find(W_NAMESPACE + "sectPr")
+        children = [child for child in body if child is not section]
+        for child in children:
+            body.remove(child)
+        for index, record in enumerate(records):
+            if index:
+                body.append(parse_xml('<w:p {}><w:r><w:br w:type="page"/></w:r></w:p>'.format(nsdecls('w'))))
+            page = etree.Element("page")
+            page.extend(deepcopy(child) for child in children)
+            merge_page(document, page, merge_values(record))
+            body.extend(list(page))
+        if section is not None:
+            body.append(section)
+    return document
+
+
+def merge_page(document, page, values):
+    """
+    Merge the values into page only. MailMerge.merge looks for the rows of list values in the whole document, which
+    for a page not added yet is the table of the page before.
+    """
+    for field, rows in values.items():
+        if not isinstance(rows, list):
+            continue
+        for table in page.iter(W_NAMESPACE + "tbl"):
+            anchors = [row for row in table if row.find('.//MergeField[@name="{}"]'.format(field)) is not None]
+            if not anchors:
+                continue
+            index = table.index(anchors[0])
+            if rows:
+                table.remove(anchors[0])
+                for offset, row_values in enumerate(rows):
+                    row = deepcopy(anchors[0])
+                    document.merge([row], **merge_values(row_values))
+                    table.insert(index + offset, row)
+            elif document.remove_empty_tables:
+                table.getparent().remove(table)
+            break
+    document.merge([page], **{field: value for field, value in values.items() if not isinstance(value, list)})
+
+
+def merge_file_chunk(template_path, chunk):
+    # runs in the worker processes of ApplyMergeFieldsBatch, the template is parsed once per process
+    template = load_template(template_path)
+    for record, target_path in chunk:
+        merge_to_file(template, record, target_path)
+
+
+def merge_to_file(template, record, target_path):
+    document = merge_copy(template)
+    document.merge(**merge_values(record))
+    document.write(target_path)
@@ -7,10 +7,51 @@ logoUrl: https://s3.amazonaws.com/lhub-public/integrations/default-integration-l
 from markdownify import markdownify
 from lhub_integ.params import ConnectionParam, ActionParam, InputType, JinjaTemplatedStr, DataType
 from lhub_integ import action
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from html.parser import HTMLParser
+import functools
+import hashlib
+import json
+import os
+import re
+import time
 
 
 base_path = "/opt/files/shared/integrationsFiles/"
 events_base = "/opt/files/service/event_files/"
+# converted documents kept by content hash
+MARKDOWN_CACHE_SIZE = 10000
+# bounded mode: characters of html parsed at a time and of sanitized html handed to markdownify at a time
+HTML_FEED_SIZE = 65536
+MARKDOWN_CHUNK_SIZE = 65536
+# bounded mode: elements nested deeper than this are dropped, their text is kept
+MAX_NESTING = 64
+# bounded mode: elements dropped with everything inside them
+STRIPPED_TAGS = {"head", "script", "style", "noscript", "template", "svg", "math", "iframe", "object", "embed", "canvas"}
+# bounded mode: the only attributes passed to markdownify
+KEPT_ATTRIBUTES = {"href", "src", "alt", "title"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+HIDDEN_STYLE = re.compile(r'display\s*:\s*none|visibility\s*:\s*hidden', re.I)
+TRUNCATION_MARKER = "\n\n[truncated]"
+
+BATCH_WORKERS = ActionParam("BATCH_WORKERS", description="Number of worker processes for large batches, 0 uses all the CPUs and 1 disables the process pool", optional=True,
+                            input_type=InputType.TEXT, data_type=DataType.INT, default="0", action="markdown_batch")
+BATCH_CHUNK_SIZE = ActionParam("BATCH_CHUNK_SIZE", description="Number of documents handed to a worker process at a time. Batches not larger than this are converted in place", optional=True,
+                               input_type=InputType.TEXT, data_type=DataType.INT, default="50", action="markdown_batch")
+
+MARKDOWN_MODE = ActionParam("MARKDOWN_MODE", description="full converts the whole document as is. bounded strips scripts, styles, hidden elements and data URIs, converts in chunks and stops at the size and time budgets", optional=True,
+                            input_type=InputType.SELECT, options=["full", "bounded"], default="full", action=["markdown", "markdown_batch"])
+MAX_HTML_CHARS = ActionParam("MAX_HTML_CHARS", description="bounded mode: characters of html read from each document, 0 for no limit", optional=True,
+                             input_type=InputType.TEXT, data_type=DataType.INT, default="5000000", action=["markdown", "markdown_batch"])
+MAX_MARKDOWN_CHARS = ActionParam("MAX_MARKDOWN_CHARS", description="bounded mode: characters of markdown returned per document, 0 for no limit", optional=True,
+                                 input_type=InputType.TEXT, data_type=DataType.INT, default="200000", action=["markdown", "markdown_batch"])
+MARKDOWN_TIME_BUDGET = ActionParam("MARKDOWN_TIME_BUDGET", description="bounded mode: seconds spent converting each document, 0 for no limit", optional=True,
+                                   input_type=InputType.TEXT, data_type=DataType.NUMBER, default="10", action=["markdown", "markdown_batch"])
+
+# markdown by sha256 of the html, least recently used first
+markdown_cache = OrderedDict()
 
 @action(name="HTML data to Markdown")
 def markdown(input:JinjaTemplatedStr):
@@ -19,8 +60,228 @@ def markdown(input:JinjaTemplatedStr):
     :param input: The data is expected to be in proper HTML format.
     :return:
     """
-    html = markdownify(input)
+    options = markdown_options()
+    html, truncated = convert_markdown(input, options)
 
-    return {
+    result = {
         "has_error": "false", "html": html
     }
+    if options["mode"] == "bounded":
+        result["truncated"] = truncated or "false"
+    return result
+
+@action(name="HTML data to Markdown Batch")
+def markdown_batch(inputs):
+    """
+    This action converts many html documents to markdown strings across worker processes. Documents already converted by this worker, or repeated in the batch, are converted only once.
+    :param inputs: A JSON array of html strings, or the file ID of a file holding a JSON array or one JSON string per line.
+    :return: The markdown strings in input order, with how many documents were converted or taken from the cache and the documents per second.
+    """
+    start = time.time()
+    try:
+        documents = read_batch_inputs(inputs)
+    except (ValueError, OSError) as e:
+        return {"has_error": "true", "error_msg": "inputs could not be read: " + str(e)}
+    options = markdown_options()
+    salt = json.dumps(options, sort_keys=True).encode("utf-8")
+    keys = [hashlib.sha256(salt + document.encode("utf-8")).hexdigest() for document in documents]
+    converted = {}
+    for key, document in zip(keys, documents):
+        if key in markdown_cache:
+            markdown_cache.move_to_end(key)
+            converted[key] = markdown_cache[key]
+    missing = OrderedDict((key, document) for key, document in zip(keys, documents) if key not in converted)
+    for key, result in zip(missing, run_batch(functools.partial(convert_markdown, options=options), list(missing.values()))):
+        converted[key] = result
+        markdown_cache[key] = result
+        if len(markdown_cache) > MARKDOWN_CACHE_SIZE:
+            markdown_cache.popitem(last=False)
+    seconds = time.time() - start
+    return {
+        "has_error": "false", "markdown": [converted[key][0] for key in keys], "documents": len(documents),
+        "converted": len(missing), "cache_hits": len(documents) - len(missing),
+        "truncated": sum(1 for key in keys if converted[key][1]), "seconds": round(seconds, 3),
+        "docs_per_sec": round(len(documents) / seconds, 1) if seconds else None
+    }
+
+def markdown_options():
+    return {"mode": MARKDOWN_MODE.read(), "max_html_chars": MAX_HTML_CHARS.read(), "max_markdown_chars": MAX_MARKDOWN_CHARS.read(),
+            "time_budget": MARKDOWN_TIME_BUDGET.read()}
+
+def convert_markdown(html, options):
+    """
+    Convert html with markdownify, in bounded mode within the budgets of the options.
+    :return: (markdown, None or the budget that truncated it: input, output or time)
+    """
+    if options["mode"] != "bounded":
+        return markdownify(html), None
+    return bounded_markdown(html, options["max_html_chars"], options["max_markdown_chars"], options["time_budget"])
+
+def bounded_markdown(html, max_html_chars, max_markdown_chars, time_budget):
+    """
+    Stream the html through SanitizingParser and convert the sanitized chunks one at a time, stopping at the first
+    chunk past the markdown size or the time budget. Memory stays within a few chunks, or the largest table, besides the input itself.
+    """
+    deadline = time.time() + time_budget if time_budget > 0 else None
+    truncated = None
+    if max_html_chars and len(html) > max_html_chars:
+        html = html[:max_html_chars]
+        truncated = "input"
+    output = []
+    size = 0
+    for chunk in sanitized_chunks(html):
+        if deadline and time.time() > deadline:
+            truncated = "time"
+            break
+        markdown = markdownify(chunk)
+        output.append(markdown)
+        size = size + len(markdown)
+        if max_markdown_chars and size > max_markdown_chars:
+            truncated = "output"
+            break
+    markdown = re.sub(r'\n{3,}', '\n\n', ''.join(output))
+    if max_markdown_chars and len(markdown) > max_markdown_chars:
+        cut = markdown.rfind("\n", 0, max_markdown_chars)
+        markdown = markdown[:cut if cut > 0 else max_markdown_chars]
+    if truncated:
+        markdown = markdown.rstrip() + TRUNCATION_MARKER
+    return markdown, truncated
+
+def sanitized_chunks(html):
+    parser = SanitizingParser()
+    for position in range(0, len(html), HTML_FEED_SIZE):
+        parser.feed(html[position:position + HTML_FEED_SIZE])
+        for chunk in parser.take_chunks():
+            yield chunk
+    parser.close()
+    for chunk in parser.take_chunks(final=True):
+        yield chunk
+
+class SanitizingParser(HTMLParser):
+    """
+    Streaming html parser that drops the STRIPPED_TAGS, hidden elements, data URIs and nesting past MAX_NESTING, and
+    hands back what is left as html chunks of about MARKDOWN_CHUNK_SIZE characters. A chunk that ends inside elements
+    closes them and the next chunk opens them again with the same attributes. Tables are not split, markdownify would
+    give the rest of the table a header row of its own, so a chunk ends after the table it is in.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # open elements as (tag, sanitized attributes)
+        self.stack = []
+        self.open_tags = Counter()
+        self.skip_tag = None
+        self.skip_level = 0
+        self.buffer = []
+        self.buffer_size = 0
+        self.chunks = []
+
+    def take_chunks(self, final=False):
+        if final and self.buffer_size:
+            self.flush()
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+    def emit(self, html):
+        self.buffer.append(html)
+        self.buffer_size = self.buffer_size + len(html)
+        if self.buffer_size >= MARKDOWN_CHUNK_SIZE and not self.open_tags["table"]:
+            self.flush()
+
+    def flush(self):
+        self.chunks.append(''.join(self.buffer) + ''.join('</{}>'.format(tag) for tag, _ in reversed(self.stack)))
+        self.buffer = ['<{}{}>'.format(tag, attributes) for tag, attributes in self.stack]
+        self.buffer_size = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.start(tag, attrs, tag in VOID_TAGS)
+
+    def handle_startendtag(self, tag, attrs):
+        self.start(tag, attrs, True)
+
+    def start(self, tag, attrs, void):
+        if self.skip_tag:
+            if tag == self.skip_tag and not void:
+                self.skip_level = self.skip_level + 1
+            return
+        attrs = dict(attrs)
+        if tag in STRIPPED_TAGS or "hidden" in attrs or HIDDEN_STYLE.search(attrs.get("style") or ""):
+            if not void:
+                self.skip_tag = tag
+                self.skip_level = 1
+            return
+        if len(self.stack) >= MAX_NESTING:
+            return
+        kept = []
+        for name, value in attrs.items():
+            if name not in KEPT_ATTRIBUTES or value is None:
+                continue
+            if value.strip().lower().startswith("data:"):
+                if tag == "img":
+                    return
+                continue
+            kept.append(' {}="{}"'.format(name, escape(value)))
+        attributes = ''.join(kept)
+        self.emit('<{}{}>'.format(tag, attributes))
+        if not void:
+            self.stack.append((tag, attributes))
+            self.open_tags[tag] = self.open_tags[tag] + 1
+
+    def handle_endtag(self, tag):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_level = self.skip_level - 1
+                if not self.skip_level:
+                    self.skip_tag = None
+            return
+        if not self.open_tags[tag]:
+            return
+        while self.stack:
+            open_tag, _ = self.stack.pop()
+            self.open_tags[open_tag] = self.open_tags[open_tag] - 1
+            self.emit('</{}>'.format(open_tag))
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.skip_tag:
+            self.emit(escape(data, quote=False))
+
+def read_batch_inputs(inputs):
+    """
+    Accept a JSON array of strings, or a file ID of a file holding either a JSON array or one JSON string per line.
+    A line that is not valid JSON is taken as is.
+    """
+    try:
+        values = json.loads(inputs)
+        if isinstance(values, list):
+            return values
+    except ValueError:
+        pass
+    with open(base_path + inputs, "r") as input_file:
+        content = input_file.read()
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    values = []
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            value = line
+        values.append(value if isinstance(value, str) else line)
+    return values
+
+def run_batch(func, values):
+    """
+    Apply func(value) to every value and return the results in input order.
+    Batches larger than one chunk go through a process pool.
+    """
+    workers = BATCH_WORKERS.read() or os.cpu_count() or 1
+    chunk_size = max(1, BATCH_CHUNK_SIZE.read())
+    if workers <= 1 or len(values) <= chunk_size:
+        return [func(value) for value in values]
+    workers = min(workers, (len(values) + chunk_size - 1) // chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, values, chunksize=chunk_size))
@@ -0,0 +1,197 @@
+"""
+Benchmarks for the RegexActions integration. This is not part of the integration, run it next to main.py
+with lhub_integ installed.
+
+    python benchmark.py suite                  rows/sec and MB/sec of every action and pattern over synthetic corpora
+    python benchmark.py profile --keywords ..  rank the keywords by time spent, most expensive first
+    python benchmark.py engines                scaling of Find Keywords and one pass Extract IOCs against the naive loops
+"""
+import argparse
+import random
+import re
+import string
+import time
+
+import main
+
+WORDS = ("the quick brown fox jumps over lazy dog alert user login failed from host at please review "
+         "attached invoice account password reset urgent payment").split()
+TLDS = ["com", "net", "org", "io", "ru"]
+
+# patterns used by the suite when none are given on the command line
+DEFAULT_REGEX = [r'\b(?:\d{1,3}\.){3}\d{1,3}\b', r'[\w.+-]+@[\w-]+\.[\w.]+', r'https?://[^\s"<>]+']
+DEFAULT_REGEX2 = [r'(?P<month>[A-Z][a-z]{2}) +(?P<day>\d+) (?P<time>[\d:]+) (?P<host>\S+)', r'(?P<tag><\w+)']
+DEFAULT_KEYWORDS = ["password urgent invoice verify account login", r"pass\w+ urg.nt in[vw]oice \d{4,} (?:re)?set"]
+
+
+def random_words(count, rnd, min_len=4, max_len=10):
+    return [''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(min_len, max_len))) for _ in range(count)]
+
+
+def random_ip(rnd):
+    return ".".join(str(rnd.randint(1, 254)) for _ in range(4))
+
+
+def random_domain(rnd):
+    return "{}.{}".format(''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(4, 12))), rnd.choice(TLDS))
+
+
+def log_lines(rows, rnd):
+    """
+    Syslog style lines with hosts, IPs and the odd URL.
+    """
+    lines = []
+    for i in range(rows):
+        message = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 15)))
+        if i % 3 == 0:
+            message = message + " src={} dst={}".format(random_ip(rnd), random_ip(rnd))
+        if i % 10 == 0:
+            message = message + " url=http://{}/{}".format(random_domain(rnd), rnd.choice(WORDS))
+        lines.append("Oct {:>2} {:02}:{:02}:{:02} host{} sshd[{}]: {}".format(
+            rnd.randint(1, 31), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59), rnd.randint(1, 50),
+            rnd.randint(100, 9999), message))
+    return lines
+
+
+def email_bodies(rows, rnd):
+    """
+    Plain text emails of a few paragraphs with addresses and links.
+    """
+    bodies = []
+    for _ in range(rows):
+        paragraphs = []
+        for _ in range(rnd.randint(2, 6)):
+            paragraphs.append(' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 80))) + ".")
+        paragraphs.append("Contact {}@{} or visit https://{}/login?id={}".format(
+            rnd.choice(WORDS), random_domain(rnd), random_domain(rnd), rnd.randint(1000, 99999)))
+        bodies.append("\n\n".join(paragraphs))
+    return bodies
+
+
+def html_pages(rows, rnd):
+    """
+    HTML documents with nested tables, links and inline styles.
+    """
+    pages = []
+    for _ in range(rows):
+        cells = []
+        for _ in range(rnd.randint(5, 30)):
+            cells.append('<td style="color:#{:06x}"><a href="https://{}/{}">{}</a></td>'.format(
+                rnd.getrandbits(24), random_domain(rnd), rnd.choice(WORDS), ' '.join(rnd.choice(WORDS) for _ in range(5))))
+        pages.append("<html><head><title>{}</title></head><body><table><tr>{}</tr></table><p>{}</p></body></html>".format(
+            rnd.choice(WORDS), ''.join(cells), ' '.join(rnd.choice(WORDS) for _ in range(50))))
+    return pages
+
+
+CORPORA = {"log": log_lines, "email": email_bodies, "html": html_pages}
+
+
+def best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def throughput(func, pattern, values, engine, repeat):
+    """
+    Time func(pattern, value, engine) over every value, the pattern is compiled before the clock starts.
+    :return: (rows/sec, MB/sec)
+    """
+    func(pattern, values[0], engine)
+    size = sum(len(value.encode("utf-8")) for value in values)
+    elapsed = best_of(lambda: [func(pattern, value, engine) for value in values], repeat)
+    return len(values) / elapsed, size / elapsed / 1000000
+
+
+def run_suite(args):
+    actions = [("Extract Multi", main.multi_match, args.regex or DEFAULT_REGEX),
+               ("Extract Named", main.named_match, args.regex2 or DEFAULT_REGEX2),
+               ("Find Keywords", main.keyword_match, args.keywords or DEFAULT_KEYWORDS)]
+    print("{:<7} {:<14} {:>12} {:>9}  {}".format("corpus", "action", "rows/sec", "MB/sec", "pattern"))
+    for corpus in args.corpus:
+        values = CORPORA[corpus](args.rows, random.Random(args.seed))
+        for name, func, patterns in actions:
+            for pattern in patterns:
+                rows_sec, mb_sec = throughput(func, pattern, values, args.engine, args.repeat)
+                print("{:<7} {:<14} {:>12.0f} {:>9.2f}  {}".format(corpus, name, rows_sec, mb_sec, pattern))
+
+
+def run_profile(args):
+    keywords = ' '.join(args.keywords or DEFAULT_KEYWORDS).split(' ')
+    for corpus in args.corpus:
+        values = CORPORA[corpus](args.rows, random.Random(args.seed))
+        print("{} corpus, {} rows".format(corpus, len(values)))
+        print("{:>10} {:>7} {:>10}  {}".format("ms", "share", "occurance", "keyword"))
+        for cost in main.keyword_costs(keywords, values, args.engine):
+            print("{:>10.2f} {:>6.1f}% {:>10}  {}".format(cost["seconds"] * 1000, cost["share_percentage"], cost["occurance"], cost["keyword"]))
+
+
+def naive_keyword_counts(keywords, search_from):
+    # the original find_keywords loop, one findall over the whole text per keyword
+    return [len(re.findall(keyword, search_from)) for keyword in keywords]
+
+
+def bench_keywords(keyword_counts=(10, 50, 200, 1000), text_size=20000):
+    """
+    Compare the per-keyword findall loop with count_keywords as the number of keywords grows.
+    """
+    rnd = random.Random(42)
+    vocabulary = random_words(2000, rnd)
+    words = []
+    size = 0
+    while size < text_size:
+        word = rnd.choice(vocabulary)
+        words.append(word)
+        size = size + len(word) + 1
+    text = ' '.join(words)
+    print("Find Keywords, {} characters of text".format(len(text)))
+    print("{:>10} {:>14} {:>14} {:>9}".format("keywords", "per-keyword ms", "engine ms", "speedup"))
+    for count in keyword_counts:
+        keywords = tuple(rnd.sample(vocabulary, count))
+        assert naive_keyword_counts(keywords, text) == main.count_keywords(keywords, text)
+        naive = best_of(lambda: naive_keyword_counts(keywords, text))
+        single = best_of(lambda: main.count_keywords(keywords, text))
+        print("{:>10} {:>14.2f} {:>14.2f} {:>8.1f}x".format(count, naive * 1000, single * 1000, naive / single))
+
+
+def bench_iocs(line_count=2000):
+    """
+    Compare a chain of Extract Multi steps, one per IOC type, with the one pass Extract IOCs.
+    """
+    text = '\n'.join(log_lines(line_count, random.Random(42)))
+    chain = best_of(lambda: [main.multi_match(regex, text) for regex in main.IOC_PATTERNS.values()])
+    single = best_of(lambda: main.ioc_match(text, True))
+    print("Extract IOCs, {} characters of text".format(len(text)))
+    print("{:>14} {:>14} {:>9}".format("chain ms", "one pass ms", "speedup"))
+    print("{:>14.2f} {:>14.2f} {:>8.1f}x".format(chain * 1000, single * 1000, chain / single))
+
+
+def run_engines(args):
+    bench_keywords()
+    bench_iocs()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="RegexActions benchmarks")
+    parser.add_argument("mode", choices=["suite", "profile", "engines"])
+    parser.add_argument("--corpus", action="append", choices=sorted(CORPORA), help="corpus to run on, repeatable, default all")
+    parser.add_argument("--rows", type=int, default=2000, help="rows per corpus")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measure, the best one is kept")
+    parser.add_argument("--engine", choices=["re", "re2"], default="re")
+    parser.add_argument("--regex", action="append", help="Extract Multi pattern, repeatable")
+    parser.add_argument("--regex2", action="append", help="Extract Named pattern, repeatable")
+    parser.add_argument("--keywords", action="append", help="space separated Find Keywords list, repeatable")
+    args = parser.parse_args()
+    args.corpus = args.corpus or sorted(CORPORA)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    {"suite": run_suite, "profile": run_profile, "engines": run_engines}[args.mode](args)
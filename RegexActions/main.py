@@ -1,14 +1,78 @@
 """
 Regular expression based text processing. For example, find multi-matches or search for keywords.
 """
-from lhub_integ.params import ConnectionParam, ActionParam
+from lhub_integ.params import ConnectionParam, ActionParam, InputType, DataType
 from lhub_integ import action
 import re
 import sys
+import os
+import json
+import mmap
+import time
+import uuid
+import signal
+import threading
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+try:
+    # optional linear-time engine, pip install google-re2
+    import re2
+except ImportError:
+    re2 = None
 
-REGEX_EXP = ActionParam("REGEX_EXP",description="enter a valid regular expression to multi-search", optional=False, action="extract_multi")
-REGEX_EXP2 = ActionParam("REGEX_EXP2",description="enter a valid regular expression with named pattern", optional=False, action="extract_named")
-KEYWORDS = ActionParam("KEYWORDS",description="enter a list of regular expressions with space separation.", optional=False, action="find_keywords")
+# upper bound of compiled patterns kept per worker process, least recently used ones are evicted first
+PATTERN_CACHE_SIZE = 512
+# upper bound of keyword lists (and their automatons) kept per worker process
+KEYWORD_CACHE_SIZE = 64
+# below this number of literal keywords, counting each one with str.count beats a single automaton scan
+AUTOMATON_MIN_LITERALS = 100
+# characters that make a keyword a regular expression rather than a plain literal
+REGEX_META_CHARS = set('.^$*+?{}[]\\|()')
+
+# building blocks of the built-in IOC patterns, a dot may be defanged as [.] (.) [dot] or (dot)
+IOC_DOT = r'(?:\.|\[\.\]|\(\.\)|\[dot\]|\(dot\))'
+IOC_OCTET = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+IOC_LABEL = r'[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?'
+IOC_HOST = r'(?:' + IOC_LABEL + IOC_DOT + r')+[A-Za-z]{2,24}\b'
+# the built-in IOC patterns, earlier types win when two of them match at the same position
+IOC_PATTERNS = OrderedDict([
+    ("url", r'\b(?:h[tx]{2}ps?|ftp)(?:://|\[:\]//|\[://\])[^\s<>"\']+'),
+    ("email", r'\b[A-Za-z0-9._%+-]+(?:@|\[@\]|\(@\)|\[at\]|\(at\))' + IOC_HOST),
+    ("ipv4", r'(?<![\d.])' + IOC_OCTET + r'(?:' + IOC_DOT + IOC_OCTET + r'){3}(?!\d)'),
+    ("sha256", r'\b[A-Fa-f0-9]{64}\b'),
+    ("sha1", r'\b[A-Fa-f0-9]{40}\b'),
+    ("md5", r'\b[A-Fa-f0-9]{32}\b'),
+    ("domain", r'\b' + IOC_HOST),
+])
+IOC_REGEX = '|'.join('(?P<{}>{})'.format(name, regex) for name, regex in IOC_PATTERNS.items())
+# whitespace separated tokens that can hold an IOC: every IOC type has a dot, @, colon, bracket or digit
+IOC_CANDIDATE_REGEX = r'(?<!\S)[^\s.@:\[(0-9]*[.@:\[(0-9]\S*'
+# defanged forms and what they are refanged to
+IOC_REFANG = [("[.]", "."), ("(.)", "."), ("[dot]", "."), ("(dot)", "."), ("[@]", "@"), ("(@)", "@"),
+              ("[at]", "@"), ("(at)", "@"), ("[:]//", "://"), ("[://]", "://")]
+
+REGEX_EXP = ActionParam("REGEX_EXP",description="enter a valid regular expression to multi-search", optional=False, action=["extract_multi","extract_multi_batch","extract_multi_file"])
+REGEX_EXP2 = ActionParam("REGEX_EXP2",description="enter a valid regular expression with named pattern", optional=False, action=["extract_named","extract_named_batch"])
+KEYWORDS = ActionParam("KEYWORDS",description="enter a list of regular expressions with space separation.", optional=False, action=["find_keywords","find_keywords_batch","profile_keywords"])
+BATCH_WORKERS = ActionParam("BATCH_WORKERS", description="Number of worker processes for large batches, 0 uses all the CPUs and 1 disables the process pool", optional=True,
+                            input_type=InputType.TEXT, data_type=DataType.INT, default="0", action=["extract_multi_batch","extract_named_batch","find_keywords_batch"])
+BATCH_CHUNK_SIZE = ActionParam("BATCH_CHUNK_SIZE", description="Number of inputs handed to a worker process at a time. Batches not larger than this are processed in place", optional=True,
+                               input_type=InputType.TEXT, data_type=DataType.INT, default="1000", action=["extract_multi_batch","extract_named_batch","find_keywords_batch"])
+SCAN_WINDOW_SIZE = ActionParam("SCAN_WINDOW_SIZE", description="Number of bytes of the file scanned per window", optional=True,
+                               input_type=InputType.TEXT, data_type=DataType.INT, default="67108864", action="extract_multi_file")
+SCAN_OVERLAP = ActionParam("SCAN_OVERLAP", description="Number of bytes each window reaches into the next one, this is the longest match that can span a window boundary", optional=True,
+                           input_type=InputType.TEXT, data_type=DataType.INT, default="65536", action="extract_multi_file")
+REGEX_ENGINE = ActionParam("REGEX_ENGINE", description="re is the Python engine. re2 is a linear-time engine that cannot backtrack catastrophically, patterns it does not support (eg, backreferences or lookarounds) fall back to re",
+                           optional=True, input_type=InputType.SELECT, default="re", options=["re", "re2"],
+                           action=["extract_multi","extract_named","find_keywords","extract_multi_batch","extract_named_batch","find_keywords_batch","profile_keywords"])
+MATCH_CPU_BUDGET = ActionParam("MATCH_CPU_BUDGET", description="Seconds of CPU time a single input may spend matching before it is aborted, 0 means no budget", optional=True,
+                               input_type=InputType.TEXT, data_type=DataType.NUMBER, default="0",
+                               action=["extract_multi","extract_named","find_keywords","extract_multi_batch","extract_named_batch","find_keywords_batch"])
+REFANG = ActionParam("REFANG", description="Refang defanged indicators, eg, hxxp://evil[.]com becomes http://evil.com", data_type=DataType.BOOL, optional=True,
+                     input_type=InputType.SELECT, default="True", options=["True", "False"], action="extract_iocs")
+
+base_path = "/opt/files/shared/integrationsFiles/"
 
 @action(name="Extract Multi")
 def extract_multi(search_from) :
@@ -17,8 +81,7 @@ def extract_multi(search_from) :
     :param search_from: Column containing data to search from
     :return: all matched patterns.
     """
-    regex = r'{}'.format(REGEX_EXP.read())
-    return {"matched":re.findall(regex, search_from)}
+    return run_match(multi_match, REGEX_EXP.read(), search_from, REGEX_ENGINE.read(), MATCH_CPU_BUDGET.read())
 
 @action(name="Extract Named")
 def extract_named(search_from) :
@@ -27,12 +90,7 @@ def extract_named(search_from) :
     :param search_from: Column containing data to search from
     :return: all matched patterns.
     """
-    regex = r'{}'.format(REGEX_EXP2.read())
-    pattern = re.compile(regex)
-    m = pattern.match(search_from)
-    if m: 
-        return m.groupdict()    
-    return {"matched":"none"}
+    return run_match(named_match, REGEX_EXP2.read(), search_from, REGEX_ENGINE.read(), MATCH_CPU_BUDGET.read())
     
 @action(name="Find Keywords")
 def find_keywords(search_from) :
@@ -41,15 +99,374 @@ def find_keywords(search_from) :
     :param search_from: Column containing data to search from
     :return: all matched patterns.
     """
-    keywords = KEYWORDS.read().split(' ')
+    return run_match(keyword_match, KEYWORDS.read(), search_from, REGEX_ENGINE.read(), MATCH_CPU_BUDGET.read())
+
+@action(name="Extract Multi Batch")
+def extract_multi_batch(inputs) :
+    """
+    Same as Extract Multi over a batch of inputs, large batches are spread over a process pool.
+    :param inputs: Column containing a JSON array of strings, or the file ID of a file holding a JSON array or one JSON string per line
+    :return: the Extract Multi results in input order.
+    """
+    return {"results":run_batch(multi_match, REGEX_EXP.read(), read_batch_inputs(inputs))}
+
+@action(name="Extract Named Batch")
+def extract_named_batch(inputs) :
+    """
+    Same as Extract Named over a batch of inputs, large batches are spread over a process pool.
+    :param inputs: Column containing a JSON array of strings, or the file ID of a file holding a JSON array or one JSON string per line
+    :return: the Extract Named results in input order.
+    """
+    return {"results":run_batch(named_match, REGEX_EXP2.read(), read_batch_inputs(inputs))}
+
+@action(name="Find Keywords Batch")
+def find_keywords_batch(inputs) :
+    """
+    Same as Find Keywords over a batch of inputs, large batches are spread over a process pool.
+    :param inputs: Column containing a JSON array of strings, or the file ID of a file holding a JSON array or one JSON string per line
+    :return: the Find Keywords results in input order.
+    """
+    return {"results":run_batch(keyword_match, KEYWORDS.read(), read_batch_inputs(inputs))}
+
+@action(name="Extract Multi from File")
+def extract_multi_file(file_id) :
+    """
+    Same as Extract Multi over the content of a file of any size. The file is memory mapped and scanned in overlapping windows,
+    and the matches are streamed into a new file with one JSON object per line.
+    :param file_id: Column containing the file ID of the file to search from
+    :return: the file ID of the matches and the number of matches.
+    """
+    output_id = str(uuid.uuid4()) + ".ndjson"
+    with open(base_path + file_id, "rb") as input_file, open(base_path + output_id, "w") as output_file:
+        count, size = scan_file(REGEX_EXP.read(), input_file, output_file, SCAN_WINDOW_SIZE.read(), SCAN_OVERLAP.read())
+    return {"lhub_file_id":output_id, "match_count":count, "bytes_scanned":size}
+
+@action(name="Extract IOCs")
+def extract_iocs(search_from) :
+    """
+    Extract IPs, domains, URLs, emails and MD5/SHA1/SHA256 hashes in one scan with the built-in patterns.
+    The host of a URL and the domain of an email are reported as well.
+    :param search_from: Column containing data to search from
+    :return: de-duplicated indicators by type.
+    """
+    return ioc_match(search_from, REFANG.read())
+
+@action(name="Profile Keywords")
+def profile_keywords(inputs) :
+    """
+    Rank the KEYWORDS patterns by the time spent matching them over a sample of inputs, so the expensive ones can be rewritten.
+    :param inputs: Column containing a JSON array of strings, or the file ID of a file holding a JSON array or one JSON string per line
+    :return: the keywords from the most to the least expensive.
+    """
+    return {"result":keyword_costs(KEYWORDS.read().split(' '), read_batch_inputs(inputs), REGEX_ENGINE.read())}
+
+@action(name="Pattern Cache Stats")
+def pattern_cache_stats() :
+    """
+    Report the compiled pattern cache counters of this worker, a growing hit count means compilation is off the per-row path.
+    :return: hits, misses, current size and max size of the cache.
+    """
+    info = get_pattern.cache_info()
+    return {"hits":info.hits, "misses":info.misses, "size":info.currsize, "max_size":info.maxsize}
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def get_pattern(regex, flags=0, engine="re"):
+    """
+    Compile the regular expression once per process, keyed by the pattern text, flags and engine.
+    The re2 engine is used when it is installed and supports the pattern, otherwise the pattern goes to re.
+    """
+    if engine == "re2" and re2 is not None and not flags:
+        options = re2.Options()
+        # patterns re2 rejects go to re, without re2 logging the parse error to stderr
+        options.log_errors = False
+        try:
+            return re2.compile(regex, options)
+        except Exception:
+            pass
+    return re.compile(regex, flags)
+
+def count_keywords(keywords, search_from, engine="re"):
+    """
+    Count the non-overlapping occurrences of every keyword, same as len(re.findall(keyword, search_from)) for each.
+    Many literal keywords are all counted in a single scan of the text, a few are counted one by one with str.count,
+    and regular expressions are matched one by one.
+    :param keywords: tuple of keywords, a keyword may be a literal or a regular expression
+    :param search_from: text to search from
+    :return: list of counts in the order of the keywords
+    """
+    literal_index, regex_index, automaton = get_keyword_matcher(keywords)
+    counts = [0] * len(keywords)
+    if automaton:
+        literal_counts = scan_automaton(automaton, search_from)
+        for i, val in zip(literal_index, literal_counts):
+            counts[i] = val
+    else:
+        for i in literal_index:
+            counts[i] = search_from.count(keywords[i])
+    for i in regex_index:
+        counts[i] = len(get_pattern(keywords[i], 0, engine).findall(search_from))
+    return counts
+
+@functools.lru_cache(maxsize=KEYWORD_CACHE_SIZE)
+def get_keyword_matcher(keywords):
+    """
+    Split the keywords into literals and regular expressions, and build the automaton of the literals once per keyword list
+    when there are enough of them.
+    A combined alternation is not used for the regular expressions as it would lose overlapping matches of different keywords.
+    """
+    literal_index = []
+    regex_index = []
+    for i, keyword in enumerate(keywords):
+        if keyword and not REGEX_META_CHARS.intersection(keyword):
+            literal_index.append(i)
+        else:
+            regex_index.append(i)
+    automaton = None
+    if len(literal_index) >= AUTOMATON_MIN_LITERALS:
+        automaton = build_automaton([keywords[i] for i in literal_index])
+    return literal_index, regex_index, automaton
+
+def build_automaton(literals):
+    """
+    Build an Aho-Corasick automaton with the failure links folded into a full transition table,
+    so the scan does a single dictionary lookup per character.
+    :return: (transitions, outputs, lengths) where outputs lists the literal indexes ending at each state
+    """
+    goto = [{}]
+    outputs = [[]]
+    for i, literal in enumerate(literals):
+        state = 0
+        for ch in literal:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto.append({})
+                outputs.append([])
+                goto[state][ch] = nxt
+            state = nxt
+        outputs[state].append(i)
+    fail = [0] * len(goto)
+    transitions = [None] * len(goto)
+    transitions[0] = dict(goto[0])
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        # the failure state is shallower, so its transitions are already complete
+        transitions[state] = dict(transitions[fail[state]])
+        transitions[state].update(goto[state])
+        for ch, nxt in goto[state].items():
+            fail[nxt] = transitions[fail[state]].get(ch, 0)
+            outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+            queue.append(nxt)
+    return transitions, outputs, [len(literal) for literal in literals]
+
+def scan_automaton(automaton, search_from):
+    """
+    Count the non-overlapping occurrences of every literal of the automaton in one pass over the text.
+    """
+    transitions, outputs, lengths = automaton
+    counts = [0] * len(lengths)
+    next_free = [0] * len(lengths)
+    state = 0
+    for pos, ch in enumerate(search_from):
+        state = transitions[state].get(ch, 0)
+        hits = outputs[state]
+        if hits:
+            for i in hits:
+                # findall resumes after the previous match, so skip matches overlapping it
+                if pos - lengths[i] + 1 >= next_free[i]:
+                    counts[i] = counts[i] + 1
+                    next_free[i] = pos + 1
+    return counts
+
+def multi_match(regex, search_from, engine="re"):
+    return {"matched":get_pattern(regex, 0, engine).findall(search_from)}
+
+def named_match(regex, search_from, engine="re"):
+    m = get_pattern(regex, 0, engine).match(search_from)
+    if m: 
+        return m.groupdict()    
+    return {"matched":"none"}
+
+def keyword_match(keywords, search_from, engine="re"):
+    keywords = keywords.split(' ')
+    counts = count_keywords(tuple(keywords), search_from, engine)
     matched = 0
     return_list = []
-    for keyword in keywords :
-        regex = r'{}'.format(keyword)
-        val = len(re.findall(regex,search_from))
+    for keyword, val in zip(keywords, counts) :
         if val > 0 :
             matched = matched + 1
         return_list.append({"keyword":keyword,"occurance":val})
     #report back
     matched_pct = int(100*matched/len(keywords))
     return {"result":{"matched_percentage": matched_pct, "details":return_list}}
+
+def keyword_costs(keywords, values, engine="re"):
+    """
+    Time every keyword on its own over all the values, the compilation is done before the clock starts.
+    :return: one entry per keyword sorted by time spent, most expensive first
+    """
+    costs = []
+    total = 0
+    for keyword in keywords:
+        pattern = get_pattern(keyword, 0, engine)
+        occurance = 0
+        start = time.perf_counter()
+        for value in values:
+            occurance = occurance + len(pattern.findall(value))
+        elapsed = time.perf_counter() - start
+        total = total + elapsed
+        costs.append({"keyword":keyword, "seconds":elapsed, "occurance":occurance})
+    for cost in costs:
+        cost["share_percentage"] = round(100 * cost["seconds"] / total, 2) if total else 0
+    return sorted(costs, key=lambda cost: cost["seconds"], reverse=True)
+
+def read_batch_inputs(inputs):
+    """
+    Accept a JSON array of strings, or a file ID of a file holding either a JSON array or one JSON string per line.
+    A line that is not valid JSON is taken as is.
+    """
+    try:
+        values = json.loads(inputs)
+        if isinstance(values, list):
+            return values
+    except ValueError:
+        pass
+    with open(base_path + inputs, "r") as input_file:
+        content = input_file.read()
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    values = []
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            value = line
+        values.append(value if isinstance(value, str) else line)
+    return values
+
+def run_batch(func, pattern, values):
+    """
+    Apply func(pattern, value) to every value and return the results in input order.
+    Batches larger than one chunk go through a process pool, every worker keeps its own compiled pattern cache.
+    """
+    workers = BATCH_WORKERS.read() or os.cpu_count() or 1
+    chunk_size = max(1, BATCH_CHUNK_SIZE.read())
+    match = functools.partial(run_match, func, pattern, engine=REGEX_ENGINE.read(), budget=MATCH_CPU_BUDGET.read())
+    if workers <= 1 or len(values) <= chunk_size:
+        return [match(value) for value in values]
+    workers = min(workers, (len(values) + chunk_size - 1) // chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(match, values, chunksize=chunk_size))
+
+def run_match(func, pattern, search_from, engine="re", budget=0):
+    """
+    Call func(pattern, search_from, engine) and abort it once it has used budget seconds of CPU time.
+    The budget relies on a profiling timer signal, so it is only enforced in the main thread.
+    """
+    if not budget or threading.current_thread() is not threading.main_thread():
+        return func(pattern, search_from, engine)
+    previous = signal.signal(signal.SIGPROF, raise_budget_exceeded)
+    signal.setitimer(signal.ITIMER_PROF, budget)
+    try:
+        return func(pattern, search_from, engine)
+    except TimeoutError:
+        return {"has_error":"true", "error_msg":"matching aborted after {} seconds of CPU time".format(budget)}
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+
+def raise_budget_exceeded(signum, frame):
+    raise TimeoutError()
+
+def scan_file(regex, input_file, output_file, window_size, overlap):
+    """
+    Run the bytes version of the regular expression over a memory mapped file, window by window.
+    A window owns the matches starting inside it and scans up to overlap bytes past its end, so a match of up to
+    overlap bytes that spans a boundary is found once. Scanning resumes after the last match like findall does.
+    :return: (number of matches, size of the file)
+    """
+    size = os.fstat(input_file.fileno()).st_size
+    if size == 0:
+        return 0, 0
+    pattern = get_pattern(regex.encode("utf-8"))
+    window_size = max(1, window_size)
+    overlap = max(0, overlap)
+    count = 0
+    last_end = 0
+    with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for start in range(0, size, window_size):
+            window_end = start + window_size
+            if window_end >= size:
+                # the last window also owns an empty match at the very end
+                window_end = size + 1
+            for m in pattern.finditer(data, max(start, last_end), min(size, window_end + overlap)):
+                if m.start() >= window_end:
+                    break
+                output_file.write(json.dumps({"offset":m.start(), "matched":match_value(m)}) + "\n")
+                count = count + 1
+                last_end = m.end()
+    return count, size
+
+def match_value(m):
+    """
+    Decode a bytes match into what findall would have returned for it.
+    """
+    if m.re.groups:
+        values = [(value or b"").decode("utf-8", "replace") for value in m.groups()]
+        return values[0] if m.re.groups == 1 else values
+    return m.group().decode("utf-8", "replace")
+
+def ioc_match(search_from, refang):
+    """
+    Find every IOC type in one pass. A cheap scan picks the tokens that can hold an IOC,
+    and only those go through the combined pattern of the built-in IOC types.
+    """
+    iocs = OrderedDict((name, OrderedDict()) for name in IOC_PATTERNS)
+    ioc_finditer = get_pattern(IOC_REGEX).finditer
+    for token in get_pattern(IOC_CANDIDATE_REGEX).findall(search_from):
+        for m in ioc_finditer(token):
+            value = m.group()
+            if m.lastgroup == "url":
+                value = value.rstrip('.,;:!?)')
+                add_ioc(iocs, "url", value, refang)
+                add_host(iocs, url_host(value), refang)
+            elif m.lastgroup == "email":
+                add_ioc(iocs, "email", value, refang)
+                add_host(iocs, email_domain(value), refang)
+            else:
+                add_ioc(iocs, m.lastgroup, value, refang)
+    result = OrderedDict((name, list(values)) for name, values in iocs.items())
+    result["count"] = sum(len(values) for values in iocs.values())
+    return result
+
+def add_ioc(iocs, ioc_type, value, refang):
+    if refang:
+        value = refang_ioc(value)
+    if ioc_type in ("domain", "md5", "sha1", "sha256"):
+        value = value.lower()
+    iocs[ioc_type][value] = True
+
+def add_host(iocs, host, refang):
+    if get_pattern(IOC_PATTERNS["ipv4"]).fullmatch(host):
+        add_ioc(iocs, "ipv4", host, refang)
+    elif get_pattern(IOC_PATTERNS["domain"]).fullmatch(host):
+        add_ioc(iocs, "domain", host, refang)
+
+def url_host(url):
+    rest = get_pattern(r'(?:://|\[:\]//|\[://\])').split(url, 1)[-1]
+    host = get_pattern(r'[/?#]').split(rest, 1)[0]
+    host = host.rsplit('@', 1)[-1]
+    return get_pattern(r':\d+$').sub('', host)
+
+def email_domain(email):
+    return get_pattern(r'(?:@|\[@\]|\(@\)|\[at\]|\(at\))').split(email)[-1]
+
+def refang_ioc(value):
+    if value[:4].lower() == "hxxp":
+        value = "http" + value[4:]
+    for defanged, refanged in IOC_REFANG:
+        value = value.replace(defanged, refanged)
+    return value
@@ -2,10 +2,50 @@
 My customized VT Integration description
 """
 import requests
-from lhub_integ.params import ConnectionParam, ActionParam, InputType
+import json
+import logging
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+from lhub_integ.params import ConnectionParam, ActionParam, InputType, DataType
 from lhub_integ import action
 
 API_KEY = ConnectionParam("API_KEY", description="Key in your API key here", input_type=InputType.PASSWORD)
+REQUESTS_PER_MINUTE = ActionParam("REQUESTS_PER_MINUTE", description="Request quota of the API key per minute, 4 for a public key", optional=True,
+                                  input_type=InputType.TEXT, data_type=DataType.INT, default="4", action=["scan_batch","report_batch"])
+VERDICT_CACHE_TTL = ActionParam("VERDICT_CACHE_TTL", description="Seconds a verdict is reused from the local cache instead of asking VirusTotal again, 0 disables the cache", optional=True,
+                                input_type=InputType.TEXT, data_type=DataType.INT, default="86400", action=["scan","scan_batch","report","report_batch"])
+VERDICT_CACHE_MAX_ENTRIES = ActionParam("VERDICT_CACHE_MAX_ENTRIES", description="Number of verdicts kept in the local cache, the oldest are evicted first", optional=True,
+                                        input_type=InputType.TEXT, data_type=DataType.INT, default="100000", action=["scan","scan_batch","report","report_batch"])
+BYPASS_CACHE = ActionParam("BYPASS_CACHE", description="Ask VirusTotal even when the local cache has a fresh verdict, the new verdict is still cached", optional=True,
+                           input_type=InputType.SELECT, data_type=DataType.BOOL, options=["True", "False"], default="False", action=["scan","scan_batch","report","report_batch"])
+RESOURCES_PER_REQUEST = ActionParam("RESOURCES_PER_REQUEST", description="Scan ids or urls asked for in one report request, 4 for a public key and up to 25 for a private one", optional=True,
+                                    input_type=InputType.TEXT, data_type=DataType.INT, default="4", action="report_batch")
+REPORT_DEADLINE = ActionParam("REPORT_DEADLINE", description="Seconds to keep polling queued scans, the ones not finished by then are returned as pending", optional=True,
+                              input_type=InputType.TEXT, data_type=DataType.INT, default="600", action="report_batch")
+
+VT_API = 'https://www.virustotal.com/vtapi/v2'
+base_path = "/opt/files/shared/integrationsFiles/"
+# SQLite file of the verdict cache, shared by every playbook run on this node
+VERDICT_CACHE_PATH = base_path + ".vt_verdict_cache.sqlite"
+# seconds to wait for the per minute quota to reset once VirusTotal answers 204 or 429
+QUOTA_RESET_SECONDS = 60
+# times a request is retried after the quota was exceeded before giving up on it
+MAX_QUOTA_RETRIES = 3
+# seconds a request may take, less when the deadline of report_batch is closer
+REQUEST_TIMEOUT = 60
+# seconds between polls of queued scans, doubled after every poll up to the maximum
+REPORT_POLL_INTERVAL = 15
+REPORT_MAX_POLL_INTERVAL = 120
+
+# token bucket shared by every request of this process, refilled at REQUESTS_PER_MINUTE
+token_bucket = {"tokens": None, "updated": 0.0, "resume_at": 0.0}
+token_bucket_lock = threading.Lock()
+# connection to the verdict cache, opened on first use
+verdict_cache = {"connection": None}
+verdict_cache_lock = threading.Lock()
+logger = logging.getLogger(__name__)
 
 @action
 def scan(url):
@@ -14,6 +54,9 @@ def scan(url):
     :param url: Input String
     :return:
     """
+    verdict = cached_verdict(url_key(url))
+    if verdict is not None:
+        return dict(verdict, cached="true")
     endpt_url = 'https://www.virustotal.com/vtapi/v2/url/scan'
     params = {'apikey': API_KEY.read(), 'url':url}
     response = requests.post(endpt_url, data=params)
@@ -21,6 +64,36 @@ def scan(url):
     return {"scan_id":response.json()['scan_id']}
 
 
+@action
+def scan_batch(urls):
+    """
+    Given a list of urls, submit each distinct one to VT for Scan within the request quota of the key
+    :param urls: JSON array of urls, or urls separated by new lines or commas
+    :return: scan_id and status by url, the status is cached, queued, quota_exceeded or error. Cached urls come with their positives and total
+    """
+    session = requests.Session()
+    results = {}
+    for url in read_urls(urls):
+        verdict = cached_verdict(url_key(url))
+        if verdict is not None:
+            results[url] = dict(verdict, status="cached")
+            continue
+        try:
+            response = vt_request(session, 'POST', '/url/scan', data={'apikey': API_KEY.read(), 'url': url})
+        except requests.RequestException as e:
+            results[url] = {"status": "error", "error_msg": str(e)}
+            continue
+        if response is None:
+            results[url] = {"status": "quota_exceeded", "error_msg": "request quota still exceeded after {} retries".format(MAX_QUOTA_RETRIES)}
+            continue
+        result = response_json(response)
+        if result.get('response_code') != 1:
+            results[url] = {"status": "error", "error_msg": response.text}
+        else:
+            results[url] = {"status": "queued", "scan_id": result['scan_id']}
+    return {"results": results}
+
+
 @action
 def report(scan_id):
     """
@@ -28,9 +101,238 @@ def report(scan_id):
     :param scan_id: Scann_ID from scan
     :return:
     """
+    verdict = cached_verdict(scan_key(scan_id))
+    if verdict is not None:
+        return {"positives":verdict['positives'],"total":verdict['total']}
     url = 'https://www.virustotal.com/vtapi/v2/url/report'
     params = {'apikey': API_KEY.read(), 'resource':scan_id}
     response = requests.get(url, params=params)
     #print(response.json())
     result=response.json()
+    if result.get('positives') is None:
+        # still queued or unknown to VirusTotal
+        return {"positives":None,"total":None,"response_code":result.get('response_code'),"verbose_msg":result.get('verbose_msg')}
+    store_verdict(result, scan_id)
     return {"positives":result['positives'],"total":result['total']}
+
+
+@action
+def report_batch(resources):
+    """
+    Given scan ids or urls, retrieve their reports from VT several per request, polling the queued ones until they finish or the deadline passes
+    :param resources: JSON array of scan ids or urls, or scan ids or urls separated by new lines or commas
+    :return: verdict and status by resource, the status is cached, done, pending, not_found, quota_exceeded or error
+    """
+    session = requests.Session()
+    deadline = time.time() + REPORT_DEADLINE.read()
+    per_request = max(1, RESOURCES_PER_REQUEST.read())
+    results = {}
+    pending = []
+    for resource in read_urls(resources):
+        verdict = cached_verdict(scan_key(resource)) or cached_verdict(url_key(resource))
+        if verdict is not None:
+            results[resource] = dict(verdict, status="cached")
+        else:
+            pending.append(resource)
+    interval = REPORT_POLL_INTERVAL
+    while pending:
+        queued = []
+        for start in range(0, len(pending), per_request):
+            chunk = pending[start:start + per_request]
+            for resource, result in zip(chunk, request_reports(session, chunk, deadline)):
+                if result is None:
+                    queued.append(resource)
+                else:
+                    results[resource] = result
+        pending = queued
+        if pending and time.time() + interval > deadline:
+            for resource in pending:
+                results[resource] = {"status": "pending", "error_msg": "scan still queued at the deadline"}
+            break
+        if pending:
+            time.sleep(interval)
+            interval = min(interval * 2, REPORT_MAX_POLL_INTERVAL)
+    return {"results": results}
+
+
+def read_urls(urls):
+    """
+    Distinct urls in the order they are first given.
+    """
+    try:
+        values = json.loads(urls)
+    except ValueError:
+        values = urls.replace(',', '\n').splitlines()
+    if not isinstance(values, list):
+        values = [values]
+    return list(dict.fromkeys(str(value).strip() for value in values if str(value).strip()))
+
+
+def request_reports(session, resources, deadline=None):
+    """
+    Ask for the reports of several resources in one request and cache the finished ones.
+    :return: the result of every resource in order, None for the ones still queued
+    """
+    try:
+        response = vt_request(session, 'POST', '/url/report', deadline, data={'apikey': API_KEY.read(), 'resource': '\n'.join(resources)})
+    except requests.RequestException as e:
+        return [{"status": "error", "error_msg": str(e)}] * len(resources)
+    if response is None:
+        return [{"status": "quota_exceeded", "error_msg": "request quota still exceeded after {} retries".format(MAX_QUOTA_RETRIES)}] * len(resources)
+    reports = response_json(response)
+    if isinstance(reports, dict):
+        reports = [reports]
+    if len(reports) != len(resources):
+        by_resource = {report.get('resource'): report for report in reports if isinstance(report, dict)}
+        reports = [by_resource.get(resource, {}) for resource in resources]
+    results = []
+    for report in reports:
+        code = report.get('response_code')
+        if code == 1 and report.get('positives') is not None:
+            store_verdict(report)
+            results.append({"status": "done", "scan_id": report.get('scan_id'), "positives": report['positives'], "total": report['total']})
+        elif code == 0:
+            results.append({"status": "not_found", "error_msg": report.get('verbose_msg')})
+        elif code == -2 or code == 1:
+            results.append(None)
+        else:
+            results.append({"status": "error", "error_msg": report.get('verbose_msg') or response.text})
+    return results
+
+
+def response_json(response):
+    try:
+        return response.json() if response.status_code == 200 else {}
+    except ValueError:
+        return {}
+
+
+def vt_request(session, method, endpoint, deadline=None, **kwargs):
+    """
+    Send a request once the token bucket allows it. When VirusTotal answers that the quota is exceeded, the bucket is
+    emptied until the quota resets and the request is sent again. A request is given REQUEST_TIMEOUT seconds, or what
+    is left before the deadline, before it fails with requests.Timeout.
+    :return: the response, or None when the quota was still exceeded after MAX_QUOTA_RETRIES retries
+    """
+    for attempt in range(MAX_QUOTA_RETRIES + 1):
+        take_token(REQUESTS_PER_MINUTE.read())
+        timeout = REQUEST_TIMEOUT if deadline is None else max(1, min(REQUEST_TIMEOUT, deadline - time.time()))
+        response = session.request(method, VT_API + endpoint, timeout=timeout, **kwargs)
+        if response.status_code not in (204, 429):
+            return response
+        pause_tokens(QUOTA_RESET_SECONDS)
+    return None
+
+
+def take_token(per_minute):
+    """
+    Wait for a token of a bucket holding up to per_minute tokens and refilled at per_minute tokens a minute.
+    """
+    per_minute = max(1, per_minute)
+    while True:
+        with token_bucket_lock:
+            now = time.time()
+            if token_bucket["tokens"] is None:
+                token_bucket["tokens"] = float(per_minute)
+            elif now > token_bucket["updated"]:
+                token_bucket["tokens"] = min(float(per_minute), token_bucket["tokens"] + (now - token_bucket["updated"]) * per_minute / 60)
+            token_bucket["updated"] = max(now, token_bucket["updated"])
+            if now >= token_bucket["resume_at"] and token_bucket["tokens"] >= 1:
+                token_bucket["tokens"] = token_bucket["tokens"] - 1
+                return
+            wait = max(token_bucket["resume_at"] - now, (1 - token_bucket["tokens"]) * 60 / per_minute)
+        time.sleep(wait)
+
+
+def pause_tokens(seconds):
+    # the bucket is full again once the quota has reset
+    with token_bucket_lock:
+        token_bucket["tokens"] = None
+        token_bucket["resume_at"] = time.time() + seconds
+        token_bucket["updated"] = token_bucket["resume_at"]
+
+
+def normalize_url(url):
+    """
+    Lower case the scheme and host, drop the default port and the fragment, so equivalent URLs share a cache entry.
+    A URL without a scheme is taken as http, as VirusTotal does.
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def url_key(url):
+    return "url:" + normalize_url(url)
+
+
+def scan_key(scan_id):
+    return "scan:" + scan_id.strip()
+
+
+def cache_connection():
+    with verdict_cache_lock:
+        if verdict_cache["connection"] is None:
+            connection = sqlite3.connect(VERDICT_CACHE_PATH, timeout=30, check_same_thread=False)
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, scan_id TEXT, positives INTEGER, total INTEGER, fetched REAL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS verdicts_fetched ON verdicts (fetched)")
+            except sqlite3.Error:
+                connection.close()
+                raise
+            verdict_cache["connection"] = connection
+        return verdict_cache["connection"]
+
+
+def cached_verdict(key):
+    """
+    The verdict cached under the key within VERDICT_CACHE_TTL, unless the cache is bypassed. A cache that cannot be
+    read is logged and taken as empty, so the verdict is asked from VirusTotal.
+    :return: scan_id, positives and total, or None
+    """
+    ttl = VERDICT_CACHE_TTL.read()
+    if ttl <= 0 or BYPASS_CACHE.read():
+        return None
+    try:
+        row = cache_connection().execute("SELECT scan_id, positives, total FROM verdicts WHERE key = ? AND fetched >= ?",
+                                         (key, time.time() - ttl)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("verdict cache %s could not be read: %s", VERDICT_CACHE_PATH, e)
+        return None
+    if row is None:
+        return None
+    return {"scan_id": row[0], "positives": row[1], "total": row[2]}
+
+
+def store_verdict(result, *scan_ids):
+    """
+    Cache a finished report under its url and scan ids, then evict expired verdicts and the oldest ones past
+    VERDICT_CACHE_MAX_ENTRIES. Reports still queued have no verdict and are not cached. Failing to write is logged only.
+    """
+    ttl = VERDICT_CACHE_TTL.read()
+    if ttl <= 0 or result.get('response_code') != 1 or result.get('positives') is None:
+        return
+    scan_id = result.get('scan_id') or (scan_ids[0] if scan_ids else None)
+    keys = {scan_key(value) for value in (scan_id,) + scan_ids if value}
+    if result.get('url'):
+        keys.add(url_key(result['url']))
+    now = time.time()
+    try:
+        connection = cache_connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+                                   [(key, scan_id, result['positives'], result['total'], now) for key in keys])
+            connection.execute("DELETE FROM verdicts WHERE fetched < ?", (now - ttl,))
+            oldest_kept = connection.execute("SELECT fetched FROM verdicts ORDER BY fetched DESC LIMIT 1 OFFSET ?",
+                                             (max(0, VERDICT_CACHE_MAX_ENTRIES.read() - 1),)).fetchone()
+            if oldest_kept is not None:
+                connection.execute("DELETE FROM verdicts WHERE fetched < ?", (oldest_kept[0],))
+    except sqlite3.Error as e:
+        logger.warning("verdict cache %s could not be written: %s", VERDICT_CACHE_PATH, e)